@@ -1,17 +1,24 @@
-from datetime import datetime
-from IPython.display import Image, display
+import asyncio
+import os
+from contextlib import AsyncExitStack
+from datetime import datetime, timedelta
 from langchain_anthropic import ChatAnthropic
 from langchain_community.tools.tavily_search import TavilySearchResults
-from langchain_core.messages import HumanMessage
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import HumanMessage, SystemMessage, ToolMessage
 from langchain_core.tools import tool
-from langgraph.checkpoint.memory import MemorySaver
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import MessagesState, START
 from langgraph.prebuilt import create_react_agent
 from langgraph.prebuilt import ToolNode
 from pydantic import BaseModel
-from tools import fetchDataFromQuery, getInstacartOrder, getUberEatsOrder
+
+import crud
+from db import DATABASE_URL, AsyncSessionLocal
+from tools import (
+    fetchDataFromQuery,
+    getInstacartOrder,
+    getUberEatsOrder,
+    searchProductsByNutrition,
+)
 
 # Set up the tool
 # We will have one real tool - a search tool
@@ -39,7 +46,7 @@ from tools import fetchDataFromQuery, getInstacartOrder, getUberEatsOrder
 #     print(chunk)
 #     print("----")
 
-tools = [fetchDataFromQuery, getInstacartOrder, getUberEatsOrder]
+tools = [fetchDataFromQuery, searchProductsByNutrition, getInstacartOrder, getUberEatsOrder]
 tool_node = ToolNode(tools)
 
 model = ChatAnthropic(model="claude-3-5-sonnet-20240620")
@@ -70,9 +77,10 @@ def should_continue(state):
         return "continue"
 
 
-def call_model(state):
+async def call_model(state):
     messages = state["messages"]
-    response = model.invoke(messages)
+    # async, so astream_events can pass the model's tokens on as they arrive
+    response = await model.ainvoke(messages)
     # We return a list, because this will get added to the existing list
     return {"messages": [response]}
 
@@ -124,24 +132,230 @@ workflow.add_edge("ask_human", "agent")
 
 # Set up memory
 
-memory = MemorySaver()
+# Checkpoints go to Postgres at DATABASE_URL; AGENT_CHECKPOINTER=sqlite keeps
+# them in the AGENT_SQLITE_PATH file instead, e.g. for local development
+AGENT_CHECKPOINTER = os.getenv("AGENT_CHECKPOINTER", "postgres")
+AGENT_SQLITE_PATH = os.getenv("AGENT_SQLITE_PATH", "agent_checkpoints.sqlite")
+AGENT_POOL_SIZE = int(os.getenv("AGENT_POOL_SIZE", "10"))
+# conversations idle for longer are deleted along with their checkpoints
+AGENT_THREAD_TTL_SECONDS = float(os.getenv("AGENT_THREAD_TTL_SECONDS", str(7 * 24 * 3600)))
+AGENT_EVICTION_INTERVAL_SECONDS = float(os.getenv("AGENT_EVICTION_INTERVAL_SECONDS", "600"))
 
-# Finally, we compile it!
-# This compiles it into a LangChain Runnable,
-# meaning you can use it as you would any other runnable
-# We add a breakpoint BEFORE the `ask_human` node so it never executes
-app = workflow.compile(checkpointer=memory, interrupt_before=["ask_human"])
+_graph = None
+_resources = None
+_evictor = None
+_delete_checkpoints = None
+_startup = asyncio.Lock()
 
-# display(Image(app.get_graph().draw_mermaid_png()))
 
-config = {"configurable": {"thread_id": "2"}}
-system_message = SystemMessage(
-    content=f"Your job is to find the relevant data to help the user using an appropriate tool and then take appropriate action items. If the user asks what they should eat you should observe the trends from the past and their glucose levels to suggest similar food items. Fetch data from past two weeks and today's date is Today's date is {datetime.now()}"
-)
-input_message = HumanMessage(
-    content="What should I have for lunch today? And go ahead and order it"
-)
-for event in app.stream(
-    {"messages": [system_message, input_message]}, config, stream_mode="values"
-):
-    event["messages"][-1].pretty_print()
+async def _open_checkpointer(stack: AsyncExitStack):
+    """
+    :return: The checkpointer and a coroutine function deleting every checkpoint of the given thread ids
+    """
+    if AGENT_CHECKPOINTER == "sqlite":
+        import aiosqlite
+        from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+        conn = await stack.enter_async_context(aiosqlite.connect(AGENT_SQLITE_PATH))
+        checkpointer = AsyncSqliteSaver(conn)
+
+        async def delete(thread_ids):
+            marks = ", ".join("?" for _ in thread_ids)
+            async with checkpointer.lock:
+                for table in ("writes", "checkpoints"):
+                    await conn.execute(f"DELETE FROM {table} WHERE thread_id IN ({marks})", thread_ids)
+                await conn.commit()
+
+    else:
+        from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+        from psycopg.rows import dict_row
+        from psycopg_pool import AsyncConnectionPool
+
+        pool = await stack.enter_async_context(
+            AsyncConnectionPool(
+                DATABASE_URL,
+                max_size=AGENT_POOL_SIZE,
+                kwargs={"autocommit": True, "prepare_threshold": 0, "row_factory": dict_row},
+                open=False,
+            )
+        )
+        checkpointer = AsyncPostgresSaver(pool)
+
+        async def delete(thread_ids):
+            async with pool.connection() as conn, conn.transaction():
+                for table in ("checkpoint_writes", "checkpoint_blobs", "checkpoints"):
+                    await conn.execute(f"DELETE FROM {table} WHERE thread_id = ANY(%s)", (thread_ids,))
+
+    await checkpointer.setup()
+    return checkpointer, delete
+
+
+async def get_graph():
+    """
+    The workflow, compiled once per process on first use against the
+    persistent checkpointer, which also starts the eviction of idle threads.
+    """
+    global _graph, _resources, _evictor, _delete_checkpoints
+    if _graph is None:
+        async with _startup:
+            if _graph is None:
+                stack = AsyncExitStack()
+                try:
+                    checkpointer, _delete_checkpoints = await _open_checkpointer(stack)
+                except BaseException:
+                    await stack.aclose()
+                    raise
+                _resources = stack
+                _evictor = asyncio.create_task(_evict_forever())
+                # We add a breakpoint BEFORE the `ask_human` node so it never executes
+                _graph = workflow.compile(checkpointer=checkpointer, interrupt_before=["ask_human"])
+    return _graph
+
+
+async def close():
+    global _graph, _resources, _evictor
+    if _evictor is not None:
+        _evictor.cancel()
+    if _resources is not None:
+        await _resources.aclose()
+    _graph = _resources = _evictor = None
+
+
+async def evict_idle_threads() -> int:
+    """
+    Deletes conversations idle for longer than AGENT_THREAD_TTL_SECONDS.
+
+    :return: Number of threads deleted
+    """
+    before = datetime.now() - timedelta(seconds=AGENT_THREAD_TTL_SECONDS)
+    deleted = 0
+    async with AsyncSessionLocal() as db:
+        while True:
+            thread_ids = await db.run_sync(crud.delete_idle_agent_threads, before=before)
+            if not thread_ids:
+                return deleted
+            # the rows go only once their checkpoints are gone, so a failed
+            # delete is retried on the next run
+            await _delete_checkpoints(thread_ids)
+            await db.commit()
+            deleted += len(thread_ids)
+
+
+async def _evict_forever():
+    while True:
+        await asyncio.sleep(AGENT_EVICTION_INTERVAL_SECONDS)
+        try:
+            deleted = await evict_idle_threads()
+            if deleted:
+                print(f"agent: evicted {deleted} idle threads")
+        except Exception as e:
+            print(e)
+
+
+def system_message():
+    return SystemMessage(
+        content=f"Your job is to find the relevant data to help the user using an appropriate tool and then take appropriate action items. If the user asks what they should eat you should observe the trends from the past and their glucose levels to suggest similar food items. Fetch data from past two weeks and today's date is Today's date is {datetime.now()}"
+    )
+
+
+def _text(content) -> str:
+    # Anthropic chunks carry a list of content blocks rather than a string
+    if isinstance(content, str):
+        return content
+    return "".join(
+        block.get("text", "") for block in content if isinstance(block, dict)
+    )
+
+
+async def _start_turn(message: str, thread_id: str):
+    """
+    Graph, config and input for one user turn, marking the thread active.
+
+    If the agent stopped to ask the user something, the message answers its
+    AskHuman call and the input is None, resuming the graph where it stopped.
+    """
+    graph = await get_graph()
+    async with AsyncSessionLocal() as db:
+        await db.run_sync(crud.touch_agent_thread, thread_id)
+    config = {"configurable": {"thread_id": thread_id}}
+    state = await graph.aget_state(config)
+    if "ask_human" in state.next:
+        # Anthropic needs every tool_use answered by a tool_result
+        tool_call_id = state.values["messages"][-1].tool_calls[0]["id"]
+        await graph.aupdate_state(
+            config,
+            {"messages": [ToolMessage(tool_call_id=tool_call_id, content=message)]},
+            as_node="ask_human",
+        )
+        return graph, config, None
+    messages = [HumanMessage(content=message)]
+    if not state.values.get("messages"):
+        messages.insert(0, system_message())
+    return graph, config, {"messages": messages}
+
+
+async def _question(graph, config):
+    state = await graph.aget_state(config)
+    if "ask_human" in state.next:
+        return state.values["messages"][-1].tool_calls[0]["args"].get("question")
+    return None
+
+
+async def run(message: str, thread_id: str) -> dict:
+    """
+    Runs one user turn on the thread.
+
+    :return: The agent's reply, and the question it stopped to ask the user, if any
+    """
+    graph, config, turn = await _start_turn(message, thread_id)
+    state = await graph.ainvoke(turn, config)
+    return {
+        "reply": _text(state["messages"][-1].content),
+        "ask_human": await _question(graph, config),
+    }
+
+
+async def history(thread_id: str) -> list:
+    graph = await get_graph()
+    state = await graph.aget_state({"configurable": {"thread_id": thread_id}})
+    return [
+        {"role": message.type, "content": _text(message.content)}
+        for message in state.values.get("messages", [])
+        if not isinstance(message, SystemMessage)
+    ]
+
+
+async def stream_events(message: str, thread_id: str):
+    """
+    Runs one user turn on the thread and yields (event, data) pairs as they
+    happen: "token" for each piece of the agent's reply, "tool_start" and
+    "tool_end" around tool calls, and "ask_human" if the agent stopped to ask
+    the user something.
+    """
+    graph, config, turn = await _start_turn(message, thread_id)
+    async for event in graph.astream_events(turn, config, version="v2"):
+        kind = event["event"]
+        if kind == "on_chat_model_stream":
+            text = _text(event["data"]["chunk"].content)
+            if text:
+                yield "token", {"text": text}
+        elif kind == "on_tool_start":
+            yield "tool_start", {"name": event["name"], "input": event["data"].get("input")}
+        elif kind == "on_tool_end":
+            yield "tool_end", {"name": event["name"], "output": str(event["data"].get("output"))}
+
+    question = await _question(graph, config)
+    if question is not None:
+        yield "ask_human", {"question": question}
+
+
+async def _demo():
+    async for name, data in stream_events(
+        "What should I have for lunch today? And go ahead and order it", "2"
+    ):
+        print(data.get("text", "") if name == "token" else f"\n[{name}] {data}")
+    await close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_demo())
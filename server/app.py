@@ -1,49 +1,85 @@
 from fastapi import FastAPI, HTTPException
-from datetime import datetime
-import json
+from bisect import bisect_left, bisect_right
+from datetime import date as Date, datetime
+from typing import Optional
+import os
+
+from catalog_store import CatalogStore
 
 app = FastAPI()
 
+# readings.json and events.json, the repository's data folder by default
+APP_DATA_DIR = os.getenv(
+    "APP_DATA_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data"),
+)
+
 # In-memory state management, a dictionary where keys are session IDs
 state_store = {}
 
-# Function to load glucose readings from JSON file
-def load_glucose_data():
-    with open('./data/readings.json') as f:
-        return json.load(f)
+# Entries of a data file sorted by timestamp, with each day's entries at
+# bounds[day] so a day or a range of days is a slice rather than a scan
+class DayIndex:
+    def __init__(self, entries):
+        timestamps = [datetime.strptime(e["timestamp"], "%Y-%m-%d %H:%M:%S") for e in entries]
+        order = sorted(range(len(entries)), key=timestamps.__getitem__)
+        self.entries = [entries[i] for i in order]
+        self.days = [timestamps[i].date().isoformat() for i in order]
+        self.bounds = {}
+        for i, day in enumerate(self.days):
+            start, _ = self.bounds.get(day, (i, i))
+            self.bounds[day] = (start, i + 1)
+
+    def day(self, day):
+        start, end = self.bounds.get(day, (0, 0))
+        return self.entries[start:end]
+
+    # Entries from the first through the last day, both included
+    def between(self, first, last):
+        return self.entries[bisect_left(self.days, first):bisect_right(self.days, last)]
+
+# Loaded on first use and again whenever the file changes
+readings = CatalogStore(os.path.join(APP_DATA_DIR, "readings.json"), DayIndex)
+events = CatalogStore(os.path.join(APP_DATA_DIR, "events.json"), DayIndex)
+
+# Entries of a day, or of the days from date through end_date
+def query_days(store, date, end_date=None):
+    try:
+        first = Date.fromisoformat(date).isoformat()
+        last = Date.fromisoformat(end_date).isoformat() if end_date else first
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be formatted as YYYY-MM-DD")
+    if last < first:
+        raise HTTPException(status_code=400, detail="end_date must not be before date")
 
-# Function to load event data from JSON file (sleep, exercise, meals, calories)
-def load_event_data():
-    with open('./data/events.json') as f:
-        return json.load(f)
+    index = store.get()
+    return index.day(first) if first == last else index.between(first, last)
 
-# Endpoint to fetch glucose data for a specific date and manage state
+# Endpoint to fetch glucose data for a specific date (or through end_date) and manage state
 @app.get("/get-glucose")
-def get_glucose(date: str, session_id: str):
-    glucose_data = load_glucose_data()
-    glucose_info = glucose_data.get(date)
+def get_glucose(date: str, session_id: str, end_date: Optional[str] = None):
+    glucose_info = query_days(readings, date, end_date)
     
     if not glucose_info:
         raise HTTPException(status_code=404, detail="No glucose data available for the provided date")
     
     # Update state for the session
-    state_store[session_id] = {"last_action": "get_glucose", "date": date}
+    state_store[session_id] = {"last_action": "get_glucose", "date": date, "end_date": end_date}
     
-    return {"date": date, "glucose_data": glucose_info}
+    return {"date": date, "end_date": end_date, "glucose_data": glucose_info}
 
-# Endpoint to fetch events (meals, exercise, sleep) for a specific date and manage state
+# Endpoint to fetch events (meals, exercise, sleep) for a specific date (or through end_date) and manage state
 @app.get("/get-events")
-def get_events(date: str, session_id: str):
-    event_data = load_event_data()
-    events_info = event_data.get(date)
+def get_events(date: str, session_id: str, end_date: Optional[str] = None):
+    events_info = query_days(events, date, end_date)
     
     if not events_info:
         raise HTTPException(status_code=404, detail="No event data available for the provided date")
     
     # Update state for the session
-    state_store[session_id] = {"last_action": "get_events", "date": date}
+    state_store[session_id] = {"last_action": "get_events", "date": date, "end_date": end_date}
     
-    return {"date": date, "events": events_info}
+    return {"date": date, "end_date": end_date, "events": events_info}
 
 # Endpoint to check the current state for a session
 @app.get("/get-state")
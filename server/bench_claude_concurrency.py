@@ -0,0 +1,151 @@
+"""
+Event-loop responsiveness under concurrent image uploads, against a local
+fake Anthropic Messages API.
+
+    python bench_claude_concurrency.py [uploads]
+
+The fake API answers every request after CLAUDE_LATENCY_SECONDS. While
+`uploads` image uploads are in flight, a cheap endpoint is polled on the
+same app; its worst latency is printed for the blocking Anthropic client
+the server used to call and for claude.estimate_nutrition. Also reports
+how many requests were in flight at the fake API at once, which the
+CLAUDE_CONCURRENCY semaphore bounds.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+from aiohttp import web
+
+FAKE_API_PORT = 8765
+CLAUDE_LATENCY_SECONDS = 1.0
+
+os.environ["ANTHROPIC_BASE_URL"] = f"http://127.0.0.1:{FAKE_API_PORT}"
+os.environ.setdefault("ANTHROPIC_API_KEY", "fake")
+
+import anthropic  # noqa: E402
+import httpx  # noqa: E402
+from fastapi import FastAPI, File, UploadFile  # noqa: E402
+
+import claude  # noqa: E402
+
+in_flight = 0
+max_in_flight = 0
+
+
+async def fake_messages(request):
+    global in_flight, max_in_flight
+    in_flight += 1
+    max_in_flight = max(max_in_flight, in_flight)
+    try:
+        await request.read()
+        await asyncio.sleep(CLAUDE_LATENCY_SECONDS)
+        return web.json_response(
+            {
+                "id": "msg_fake",
+                "type": "message",
+                "role": "assistant",
+                "model": claude.CLAUDE_MODEL,
+                "content": [{"type": "text", "text": '{"data": {"calories": 400}}'}],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": {"input_tokens": 1, "output_tokens": 1},
+            }
+        )
+    finally:
+        in_flight -= 1
+
+
+def build_app():
+    app = FastAPI()
+    blocking_client = anthropic.Anthropic()
+
+    @app.post("/upload-image/blocking")
+    async def upload_image_blocking(file: UploadFile = File(...)):
+        # what /upload-image/ used to do: a sync call inside an async handler
+        blocking_client.messages.create(
+            model=claude.CLAUDE_MODEL,
+            max_tokens=1024,
+            messages=[{"role": "user", "content": "image"}],
+        )
+        return {}
+
+    @app.post("/upload-image/")
+    async def upload_image(file: UploadFile = File(...)):
+        await claude.estimate_nutrition(await file.read(), file.content_type)
+        return {}
+
+    @app.get("/ping")
+    async def ping():
+        return {}
+
+    return app
+
+
+async def run(client, path, uploads):
+    global max_in_flight
+    max_in_flight = 0
+    ping_latencies = []
+
+    done = asyncio.Event()
+
+    # time from when a ping is due until it completes, so a blocked loop
+    # counts against the ping that couldn't even be sent
+    async def poll():
+        due = time.perf_counter()
+        while True:
+            await client.get("/ping")
+            now = time.perf_counter()
+            ping_latencies.append(now - due)
+            if done.is_set():
+                return
+            due = now + 0.05
+            await asyncio.sleep(0.05)
+
+    poller = asyncio.create_task(poll())
+    await asyncio.sleep(0.1)
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            client.post(path, files={"file": ("meal.jpg", b"\xff\xd8fake", "image/jpeg")})
+            for _ in range(uploads)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    done.set()
+    await poller
+
+    print(
+        f"{path:24} {uploads} uploads in {elapsed:5.1f} s, "
+        f"worst /ping {max(ping_latencies) * 1000:6.0f} ms, "
+        f"max in flight at API {max_in_flight}"
+    )
+
+
+def serve_fake_api():
+    """
+    Runs the fake API on its own thread and loop, so a handler that blocks
+    the app's loop can't stall it too.
+    """
+    loop = asyncio.new_event_loop()
+    fake_api = web.Application()
+    fake_api.router.add_post("/v1/messages", fake_messages)
+    runner = web.AppRunner(fake_api)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", FAKE_API_PORT).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+
+async def main(uploads):
+    transport = httpx.ASGITransport(app=build_app())
+    async with httpx.AsyncClient(transport=transport, base_url="http://app", timeout=120) as client:
+        await run(client, "/upload-image/blocking", min(uploads, 5))
+        await run(client, "/upload-image/", uploads)
+
+
+if __name__ == "__main__":
+    serve_fake_api()
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
@@ -0,0 +1,112 @@
+import random
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from detection import (
+    interesting_events,
+    time_ranges_dropping_quickly,
+    time_ranges_hyperglycemic,
+    time_ranges_hypoglycemic,
+    time_ranges_of_interest,
+    time_ranges_of_interest_arrays,
+    time_ranges_raising_quickly,
+)
+
+# stand-in for GlucoseReading so the benchmark doesn't need a database
+Reading = namedtuple("Reading", ["timestamp", "glucose_value"])
+Event = namedtuple("Event", ["timestamp", "type"])
+
+
+def synthetic_readings(n, seed=0):
+    """
+    Random-walk CGM trace sampled every 5 minutes.
+    """
+    rng = random.Random(seed)
+    t = datetime(2024, 1, 1)
+    value = 120
+    readings = []
+    for _ in range(n):
+        value = min(400, max(40, value + rng.randint(-6, 6)))
+        readings.append(Reading(t, value))
+        t += timedelta(minutes=5)
+    return readings
+
+
+def synthetic_events(readings, every=12, seed=0):
+    """
+    Roughly one event an hour, shuffled so the index has to sort them.
+    """
+    rng = random.Random(seed)
+    events = [
+        Event(r.timestamp + timedelta(minutes=rng.randint(0, 4)), "food")
+        for r in readings[::every]
+    ]
+    rng.shuffle(events)
+    return events
+
+
+def scan_interesting_events(times, events, lookback_minutes=20):
+    window = timedelta(minutes=lookback_minutes)
+    result = {}
+    for type, ranges in times.items():
+        result[type] = []
+        for start, end in ranges:
+            matched = [
+                event
+                for event in events
+                if start - window <= event.timestamp <= end - window
+            ]
+            if matched:
+                result[type].append(
+                    {"range": (start, end), "events": matched}
+                )
+    return result
+
+
+def loop_time_ranges_of_interest(data):
+    return {
+        "hyperglycemic": time_ranges_hyperglycemic(data, 180),
+        "hypoglycemic": time_ranges_hypoglycemic(data, 70),
+        "quickly_raising": time_ranges_raising_quickly(data, 2),
+        "quickly_dropping": time_ranges_dropping_quickly(data, 2),
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    readings = synthetic_readings(n)
+    timestamps = [r.timestamp for r in readings]
+    values = [r.glucose_value for r in readings]
+
+    expected, loop_time = timed(loop_time_ranges_of_interest, readings)
+    from_readings, readings_time = timed(time_ranges_of_interest, readings)
+    from_arrays, arrays_time = timed(time_ranges_of_interest_arrays, timestamps, values)
+
+    assert from_readings == expected
+    assert from_arrays == expected
+
+    print(f"{n} readings, {sum(len(r) for r in expected.values())} ranges")
+    print(f"python loops:                   {loop_time * 1000:9.1f} ms")
+    print(f"time_ranges_of_interest:        {readings_time * 1000:9.1f} ms")
+    print(f"time_ranges_of_interest_arrays: {arrays_time * 1000:9.1f} ms")
+
+    # the scan is O(ranges x events), so compare on a slice of the trace
+    readings = readings[: min(n, 50_000)]
+    events = synthetic_events(readings)
+    times = time_ranges_of_interest(readings)
+    expected, scan_time = timed(scan_interesting_events, times, events)
+    indexed, indexed_time = timed(interesting_events, times, events)
+
+    assert indexed == expected
+
+    print(f"\n{len(readings)} readings, {len(events)} events")
+    print(f"interesting_events scan:        {scan_time * 1000:9.1f} ms")
+    print(f"interesting_events indexed:     {indexed_time * 1000:9.1f} ms")
@@ -0,0 +1,88 @@
+"""
+Throughput of glucose ingestion against the configured database.
+
+    python bench_glucose_upload.py [readings]
+
+Compares crud.create_glucose_batch (ORM bulk_save_objects) with
+crud.upsert_glucose_rows (COPY + INSERT ... ON CONFLICT) on 100k readings
+by default, then re-uploads the same readings to time the overlapping case.
+The readings are dated in 2000 and deleted afterwards.
+"""
+
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete
+
+import crud
+from db import SessionLocal
+from models import GlucoseExcursion, GlucoseReading
+from requests2 import GlucoseCreate
+
+BENCH_START = datetime(2000, 1, 1)
+
+
+def synthetic_records(n, seed=0):
+    rng = random.Random(seed)
+    value = 120
+    records = []
+    for i in range(n):
+        value = min(400, max(40, value + rng.randint(-6, 6)))
+        records.append(
+            GlucoseCreate(timestamp=BENCH_START + timedelta(minutes=5 * i), glucose_value=value)
+        )
+    return records
+
+
+def cleanup(db, end):
+    db.execute(
+        delete(GlucoseReading).where(
+            GlucoseReading.timestamp >= BENCH_START, GlucoseReading.timestamp <= end
+        )
+    )
+    db.execute(
+        delete(GlucoseExcursion).where(
+            GlucoseExcursion.start >= BENCH_START, GlucoseExcursion.start <= end
+        )
+    )
+    crud.refresh_glucose_excursions(db, since=BENCH_START)
+    db.commit()
+
+
+def report(label, n, seconds, counts=None):
+    line = f"{label:34} {seconds:7.2f} s  {n / seconds:10.0f} readings/s"
+    if counts:
+        line += f"  inserted={counts['inserted']} updated={counts['updated']} skipped={counts['skipped']}"
+    print(line)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    records = synthetic_records(n)
+    rows = [(record.timestamp, record.glucose_value) for record in records]
+    end = records[-1].timestamp
+
+    with SessionLocal() as db:
+        cleanup(db, end)
+
+        start = time.perf_counter()
+        crud.create_glucose_batch(db, records)
+        report("bulk_save_objects, new readings", n, time.perf_counter() - start)
+        cleanup(db, end)
+
+        start = time.perf_counter()
+        counts = crud.upsert_glucose_rows(db, rows)
+        report("COPY upsert, new readings", n, time.perf_counter() - start, counts)
+
+        start = time.perf_counter()
+        counts = crud.upsert_glucose_rows(db, rows)
+        report("COPY upsert, all overlapping", n, time.perf_counter() - start, counts)
+
+        shifted = [(timestamp, value + 1) for timestamp, value in rows]
+        start = time.perf_counter()
+        counts = crud.upsert_glucose_rows(db, shifted, on_conflict="update")
+        report("COPY upsert, update values", n, time.perf_counter() - start, counts)
+
+        cleanup(db, end)
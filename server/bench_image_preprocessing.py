@@ -0,0 +1,37 @@
+"""
+Size and time of image_preprocessing.prepare_image over sample images.
+
+    python bench_image_preprocessing.py [image ...]
+
+Defaults to every image in ../uploads. Sizes are reported both raw and as
+the base64 the Messages API request carries.
+"""
+
+import glob
+import os
+import sys
+
+from image_preprocessing import prepare_image
+
+
+def base64_size(n):
+    return 4 * ((n + 2) // 3)
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join("..", "uploads", "*")))
+    total_in = total_out = 0
+    for path in paths:
+        with open(path, "rb") as f:
+            image = f.read()
+        prepared = prepare_image(image, "image/jpeg")
+        total_in += len(image)
+        total_out += len(prepared.data)
+        print(
+            f"{os.path.basename(path):28} "
+            f"{base64_size(len(image)) / 1024:8.0f} KiB -> {base64_size(len(prepared.data)) / 1024:6.0f} KiB base64 "
+            f"({100 * prepared.saved_bytes / len(image):4.1f}% smaller) "
+            f"in {prepared.seconds * 1000:5.0f} ms"
+        )
+    if paths:
+        print(f"total {total_in} -> {total_out} bytes, {100 * (1 - total_out / total_in):.1f}% smaller")
@@ -0,0 +1,119 @@
+"""
+Query plans for the time_series_events access patterns with and without the
+indexes from migrations/versions/0001, on a seeded copy of the table.
+
+    python bench_indexes.py [rows]
+
+Seeds `rows` events (10M by default) into a scratch `bench` schema on the
+configured database, so the real tables are left alone. The schema is
+dropped at the end.
+"""
+
+import sys
+import time
+
+from sqlalchemy import text
+
+from db import engine
+
+QUERIES = {
+    # crud.get_time_series_events
+    "window + type, limit 100": """
+        SELECT * FROM bench.time_series_events
+        WHERE "timestamp" >= '2024-06-01' AND "timestamp" <= '2024-06-14' AND type = 'food'
+        OFFSET 0 LIMIT 100
+    """,
+    # crud.combined_data_query
+    "window + type in (...)": """
+        SELECT * FROM bench.time_series_events
+        WHERE "timestamp" >= '2024-06-01' AND "timestamp" <= '2024-06-14'
+        AND type IN ('food', 'insulin')
+    """,
+    # crud.get_time_series_events_by_type
+    "type, offset 10000": """
+        SELECT * FROM bench.time_series_events
+        WHERE type = 'exercise'
+        OFFSET 10000 LIMIT 100
+    """,
+    # nutrient lookup
+    "data @> carbohydrate": """
+        SELECT * FROM bench.time_series_events
+        WHERE data @> '{"carbohydrate": 24}'
+    """,
+}
+
+INDEXES = [
+    'CREATE INDEX ON bench.time_series_events (type, "timestamp")',
+    'CREATE INDEX ON bench.time_series_events ("timestamp")',
+    "CREATE INDEX ON bench.time_series_events USING gin (data)",
+]
+
+
+def seed(conn, rows):
+    conn.execute(text("DROP SCHEMA IF EXISTS bench CASCADE"))
+    conn.execute(text("CREATE SCHEMA bench"))
+    conn.execute(
+        text(
+            """
+            CREATE TABLE bench.time_series_events (
+                id serial PRIMARY KEY,
+                type varchar NOT NULL,
+                "timestamp" timestamp NOT NULL,
+                data jsonb,
+                description text
+            )
+            """
+        )
+    )
+    # roughly one event a minute from 2020 on, spread over four types
+    conn.execute(
+        text(
+            """
+            INSERT INTO bench.time_series_events (type, "timestamp", data, description)
+            SELECT
+                (ARRAY['food', 'insulin', 'exercise', 'sleep'])[1 + i % 4],
+                timestamp '2020-01-01' + i * interval '1 minute',
+                CASE WHEN i % 4 = 0
+                    THEN jsonb_build_object('calories', i % 800, 'carbohydrate', i % 97, 'protein', i % 41)
+                    ELSE jsonb_build_object('units', i % 12)
+                END,
+                'seeded'
+            FROM generate_series(1, :rows) AS i
+            """
+        ),
+        {"rows": rows},
+    )
+    conn.execute(text("ANALYZE bench.time_series_events"))
+
+
+def explain(conn, query):
+    plan = conn.execute(text(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}")).scalar()[0]
+    return plan["Plan"]["Node Type"], plan["Execution Time"]
+
+
+def report(conn, label):
+    print(f"\n{label}")
+    for name, query in QUERIES.items():
+        node, ms = explain(conn, query)
+        print(f"  {name:28} {node:24} {ms:10.1f} ms")
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+
+    with engine.begin() as conn:
+        start = time.perf_counter()
+        seed(conn, rows)
+        print(f"seeded {rows} events in {time.perf_counter() - start:.1f} s")
+
+        report(conn, "without indexes")
+
+        start = time.perf_counter()
+        for index in INDEXES:
+            conn.execute(text(index))
+        conn.execute(text("ANALYZE bench.time_series_events"))
+        print(f"\nbuilt indexes in {time.perf_counter() - start:.1f} s")
+
+        report(conn, "with indexes")
+
+        conn.execute(text("DROP SCHEMA bench CASCADE"))
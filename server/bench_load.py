@@ -0,0 +1,72 @@
+"""
+Concurrent dashboard load against a running server.
+
+    python bench_load.py [base_url] [clients] [seconds]
+
+Each simulated client loops over the requests the dashboard makes on load
+(glucose, events and interesting times for the last two weeks) for the given
+duration. Prints throughput and latency percentiles; run it against the
+server before and after a change to compare. Defaults to 200 clients for
+30 seconds against http://localhost:8000.
+"""
+
+import asyncio
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+
+def dashboard_requests(now):
+    window = {
+        "start": (now - timedelta(days=14)).strftime("%Y-%m-%d %H:%M:%S"),
+        "end": now.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    return [
+        ("/glucose/", window),
+        ("/events/", window),
+        ("/interesting-times/", window),
+    ]
+
+
+async def client_loop(client, requests, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        for path, params in requests:
+            start = time.perf_counter()
+            try:
+                response = await client.get(path, params=params)
+                if response.status_code >= 500:
+                    errors.append(response.status_code)
+            except httpx.HTTPError as e:
+                errors.append(type(e).__name__)
+            latencies.append(time.perf_counter() - start)
+
+
+async def main(base_url, clients, seconds):
+    requests = dashboard_requests(datetime.now())
+    latencies = []
+    errors = []
+    limits = httpx.Limits(max_connections=clients)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        deadline = time.perf_counter() + seconds
+        await asyncio.gather(
+            *(client_loop(client, requests, deadline, latencies, errors) for _ in range(clients))
+        )
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{clients} clients, {seconds} s against {base_url}")
+    print(f"requests: {len(latencies)} ({len(latencies) / seconds:.1f}/s), errors: {len(errors)}")
+    print(
+        f"latency p50 {quantiles[49] * 1000:.0f} ms, "
+        f"p95 {quantiles[94] * 1000:.0f} ms, "
+        f"p99 {quantiles[98] * 1000:.0f} ms"
+    )
+
+
+if __name__ == "__main__":
+    base_url = sys.argv[1] if len(sys.argv) > 1 else "http://localhost:8000"
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    seconds = int(sys.argv[3]) if len(sys.argv) > 3 else 30
+    asyncio.run(main(base_url, clients, seconds))
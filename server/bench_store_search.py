@@ -0,0 +1,117 @@
+"""
+instacart.search_stores on a synthetic catalog.
+
+    python bench_store_search.py [stores]
+
+Compares the per-store regex scan search_stores used to do with the token
+indexes of instacart.StoreSearch, on a mix of whole-word, prefix, typo and
+location queries. Defaults to 50,000 stores.
+"""
+
+import random
+import re
+import sys
+import time
+
+from instacart import StoreSearch
+
+ADJECTIVES = ["fresh", "green", "urban", "golden", "happy", "corner", "family", "sunny", "harvest", "prairie"]
+NOUNS = ["market", "grocer", "pantry", "foods", "basket", "table", "garden", "farm", "co-op", "depot"]
+TAGS = [
+    "organic", "local", "gourmet", "budget", "bulk", "asian", "latin", "kosher", "halal", "vegan",
+    "bakery", "deli", "seafood", "butcher", "pharmacy", "wine", "beer", "flowers", "international", "convenience",
+    "health", "natural", "specialty", "discount", "premium", "produce", "dairy", "frozen", "snacks", "coffee",
+]
+STATES = ["WA", "OR", "CA", "ID", "NV", "AZ", "UT", "MT", "CO", "NM"]
+SYLLABLES = ["ka", "lo", "mi", "ran", "dell", "ton", "ber", "ash", "wick", "ford", "vale", "mont", "ridge", "port"]
+
+
+def synthetic_stores(n, seed=0):
+    rng = random.Random(seed)
+    cities = sorted({"".join(rng.choices(SYLLABLES, k=3)).title() for _ in range(2000)})
+    return [
+        {
+            "id": i,
+            "name": f"{rng.choice(cities)} {rng.choice(ADJECTIVES).title()} {rng.choice(NOUNS).title()}",
+            "location": {"city": rng.choice(cities), "state": rng.choice(STATES)},
+            "tags": rng.sample(TAGS, 3),
+            "products": [],
+        }
+        for i in range(n)
+    ], cities
+
+
+def scan_search_stores(stores, query, location):
+    """
+    search_stores before the indexes: a regex search over every store.
+    """
+    results = []
+    query = query.lower()
+    location = location.lower()
+    for store in stores:
+        store_name = store["name"].lower()
+        store_tags = [tag.lower() for tag in store["tags"]]
+        store_location = f"{store['location']['city']}, {store['location']['state']}".lower()
+        if (
+            re.search(query, store_name)
+            or any(re.search(query, tag) for tag in store_tags)
+            or re.search(location, store_location)
+        ):
+            results.append(store)
+    return results
+
+
+def queries(cities, count, seed=1):
+    rng = random.Random(seed)
+    result = []
+    for i in range(count):
+        tag = rng.choice(TAGS)
+        city = rng.choice(cities)
+        kind = i % 4
+        if kind == 0:
+            result.append((f"{tag} {rng.choice(NOUNS)}", city))
+        elif kind == 1:
+            result.append((tag[:4], city))
+        elif kind == 2:
+            # a typo: one letter dropped
+            cut = rng.randrange(1, len(tag))
+            result.append((tag[:cut] + tag[cut + 1 :], city))
+        else:
+            result.append((f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}", f"{city} {rng.choice(STATES)}"))
+    return result
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    stores, cities = synthetic_stores(n)
+
+    start = time.perf_counter()
+    search = StoreSearch(stores)
+    build_time = time.perf_counter() - start
+
+    sample = queries(cities, 200)
+    start = time.perf_counter()
+    matched = [len(search.search(query, location)) for query, location in sample]
+    index_time = (time.perf_counter() - start) / len(sample)
+
+    start = time.perf_counter()
+    ids = [search.by_name.search(query) | search.by_location.search(location) for query, location in sample]
+    lookup_time = (time.perf_counter() - start) / len(sample)
+
+    scanned = sample[:10]
+    start = time.perf_counter()
+    for query, location in scanned:
+        scan_search_stores(stores, query, location)
+    scan_time = (time.perf_counter() - start) / len(scanned)
+
+    # a single whole tag and city match the same stores either way
+    rng = random.Random(2)
+    for query, location in [(rng.choice(TAGS), rng.choice(cities)) for _ in range(10)]:
+        expected = scan_search_stores(stores, query, location)
+        assert [s["id"] for s in search.search(query, location)] == [s["id"] for s in expected]
+
+    print(f"{n} stores, index built in {build_time * 1000:.0f} ms")
+    print(f"median {sorted(matched)[len(matched) // 2]} stores per query")
+    print(f"regex scan:              {scan_time * 1000:9.3f} ms/query")
+    print(f"index lookup (ids):      {lookup_time * 1000:9.3f} ms/query")
+    print(f"index search (stores):   {index_time * 1000:9.3f} ms/query")
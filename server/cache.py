@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Dictionary bounded to `maxsize` entries, evicting the least recently used.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def values(self):
+        return list(self._data.values())
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TTLCache(LRUCache):
+    """
+    LRUCache whose entries expire `ttl` seconds after they were put.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super().get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            return default
+        return value
+
+    def put(self, key, value):
+        super().put(key, (time.monotonic() + self.ttl, value))
+
+    def values(self):
+        now = time.monotonic()
+        return [value for expires, value in super().values() if expires > now]
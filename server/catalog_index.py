@@ -0,0 +1,120 @@
+import re
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Dict, FrozenSet, Iterable, List, Set, Tuple
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+# tokens shorter than this only match exactly, longer ones also as a prefix
+MIN_PREFIX_LENGTH = 3
+# tokens at least this long also match words one typo away
+MIN_FUZZY_LENGTH = 4
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+def _deletes(token: str) -> Set[str]:
+    return {token[:i] + token[i + 1 :] for i in range(len(token))}
+
+
+def _one_edit(a: str, b: str) -> bool:
+    """
+    Whether a and b differ by one inserted, deleted or substituted character,
+    or two swapped neighbouring ones.
+    """
+    if abs(len(a) - len(b)) > 1:
+        return False
+    # skip the common prefix and suffix, at most one edit may remain
+    start = 0
+    while start < min(len(a), len(b)) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < min(len(a), len(b)) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a, b = a[start : len(a) - end], b[start : len(b) - end]
+    if len(a) <= 1 and len(b) <= 1:
+        return True
+    return len(a) == len(b) == 2 and a == b[::-1]
+
+
+class TokenIndex:
+    """
+    Inverted index from lowercase word tokens to document ids, built once
+    and never modified. A query matches the documents containing every one
+    of its tokens, where a token matches a word exactly, as a prefix of it,
+    or, if neither finds anything, one edit (typo) away from it.
+    """
+
+    def __init__(self, documents: Iterable[Tuple[int, Iterable[str]]]):
+        postings: Dict[str, Set[int]] = defaultdict(set)
+        ids = set()
+        for doc_id, texts in documents:
+            ids.add(doc_id)
+            for text in texts:
+                for token in tokenize(text):
+                    postings[token].add(doc_id)
+
+        self.ids: FrozenSet[int] = frozenset(ids)
+        self.postings: Dict[str, FrozenSet[int]] = {
+            token: frozenset(doc_ids) for token, doc_ids in postings.items()
+        }
+        self.vocabulary = sorted(self.postings)
+        # symmetric delete index: every word with one character removed
+        self.deletes: Dict[str, Set[str]] = defaultdict(set)
+        for token in self.vocabulary:
+            if len(token) >= MIN_FUZZY_LENGTH - 1:
+                for variant in _deletes(token):
+                    self.deletes[variant].add(token)
+
+    def _prefixed(self, token: str) -> List[str]:
+        start = bisect_left(self.vocabulary, token)
+        end = bisect_left(self.vocabulary, token + "\uffff", start)
+        return self.vocabulary[start:end]
+
+    def _fuzzy(self, token: str) -> Set[str]:
+        variants = _deletes(token)
+        words = {word for word in variants if word in self.postings}
+        words.update(self.deletes.get(token, ()))
+        for variant in variants:
+            words.update(self.deletes.get(variant, ()))
+        # words sharing a delete with the token can be two edits away
+        return {word for word in words if _one_edit(token, word)}
+
+    def expand(self, token: str) -> Set[str]:
+        """
+        Words in the index the query token matches.
+        """
+        if len(token) < MIN_PREFIX_LENGTH:
+            return {token} if token in self.postings else set()
+        words = set(self._prefixed(token))
+        if not words and len(token) >= MIN_FUZZY_LENGTH:
+            words = self._fuzzy(token)
+        return words
+
+    def search(self, text: str) -> FrozenSet[int]:
+        """
+        Ids of the documents matching every token of the text; all of them
+        for text without any tokens.
+        """
+        matches = []
+        for token in set(tokenize(text)):
+            words = self.expand(token)
+            if not words:
+                return frozenset()
+            if len(words) == 1:
+                matches.append(self.postings[words.pop()])
+            else:
+                matches.append(frozenset().union(*(self.postings[word] for word in words)))
+        if not matches:
+            return self.ids
+
+        # intersect starting from the most selective token
+        matches.sort(key=len)
+        result = matches[0]
+        for other in matches[1:]:
+            result = result & other
+            if not result:
+                break
+        return result
@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Generic, NamedTuple, Optional, Tuple, TypeVar
+
+import ijson
+
+# catalogs are looked up here rather than relative to the working directory
+CATALOG_DIR = os.getenv(
+    "CATALOG_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+)
+# how often a catalog file is checked for changes, at most
+CATALOG_RELOAD_CHECK_SECONDS = float(os.getenv("CATALOG_RELOAD_CHECK_SECONDS", "2"))
+# files at least this large are parsed as a stream
+CATALOG_STREAM_THRESHOLD_BYTES = int(
+    os.getenv("CATALOG_STREAM_THRESHOLD_BYTES", str(32 * 1024 * 1024))
+)
+
+T = TypeVar("T")
+
+
+def load_entities(path: str) -> list:
+    """
+    The top-level list of a JSON catalog file. Large files are parsed one
+    entity at a time with ijson, so the file's text is never held in memory
+    next to the parsed catalog.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= CATALOG_STREAM_THRESHOLD_BYTES:
+            return list(ijson.items(f, "item", use_float=True))
+        return json.load(f)
+
+
+class _Snapshot(NamedTuple):
+    version: Tuple[int, int]
+    value: object
+
+
+class CatalogStore(Generic[T]):
+    """
+    A catalog file and everything derived from it, loaded on first use.
+
+    `build` turns the file's entities into whatever the callers need (the
+    entities plus their indexes), and get() returns that object. When the
+    file's mtime or size changes it is rebuilt off to the side and swapped
+    in as a whole, so a caller that holds on to one result never sees data
+    and indexes from different versions. If the new file can't be loaded,
+    the previous version keeps being served.
+    """
+
+    def __init__(self, filename: str, build: Callable[[list], T]):
+        """
+        :param filename: Name of the file in CATALOG_DIR, or an absolute path
+        :param build: Builds the catalog from the file's top-level list
+        """
+        self.path = os.path.join(CATALOG_DIR, filename)
+        self.build = build
+        self._snapshot: Optional[_Snapshot] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> T:
+        snapshot = self._snapshot
+        if snapshot is None or time.monotonic() >= self._next_check:
+            snapshot = self._refresh()
+        return snapshot.value
+
+    def _refresh(self) -> _Snapshot:
+        with self._lock:
+            now = time.monotonic()
+            if self._snapshot is not None and now < self._next_check:
+                # another thread just checked
+                return self._snapshot
+            self._next_check = now + CATALOG_RELOAD_CHECK_SECONDS
+
+            start = time.perf_counter()
+            try:
+                stat = os.stat(self.path)
+                version = (stat.st_mtime_ns, stat.st_size)
+                if self._snapshot is not None and self._snapshot.version == version:
+                    return self._snapshot
+                value = self.build(load_entities(self.path))
+            except Exception as e:
+                if self._snapshot is None:
+                    raise
+                print(f"catalog {self.path}: reload failed, keeping the previous version: {e}")
+                return self._snapshot
+
+            self._snapshot = _Snapshot(version, value)
+            print(f"catalog {self.path}: loaded in {(time.perf_counter() - start) * 1000:.0f} ms")
+            return self._snapshot
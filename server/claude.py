@@ -0,0 +1,219 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+from itertools import chain
+
+import anthropic
+import httpx
+
+from consequence_retrieval import estimate_tokens
+from prompts import CONSEQUENCES_PROMPT, NUTRITION_FACTS_PLEASE_PROMPT
+
+CLAUDE_MODEL = "claude-3-5-sonnet-20240620"  # Model name for Claude API
+
+# at most this many requests to Claude in flight per worker, the rest wait
+CLAUDE_CONCURRENCY = int(os.getenv("CLAUDE_CONCURRENCY", "8"))
+# per attempt; the SDK retries connection errors, timeouts, 429s and 5xxs
+# with exponential backoff up to CLAUDE_MAX_RETRIES times
+CLAUDE_TIMEOUT_SECONDS = float(os.getenv("CLAUDE_TIMEOUT_SECONDS", "60"))
+CLAUDE_MAX_RETRIES = int(os.getenv("CLAUDE_MAX_RETRIES", "3"))
+
+client = anthropic.AsyncAnthropic(
+    timeout=CLAUDE_TIMEOUT_SECONDS, max_retries=CLAUDE_MAX_RETRIES
+)
+_slots = asyncio.Semaphore(CLAUDE_CONCURRENCY)
+
+
+logger = logging.getLogger(__name__)
+
+# Static instructions go in the system prompt, ahead of anything per-request.
+# Anthropic only caches a prefix of at least this many tokens (1024 for
+# Sonnet); a shorter one is processed in full on every call whatever its
+# cache_control says. Neither prompt is that long today (~340 and ~170
+# tokens), so both are sent without a breakpoint through the regular
+# messages API, and caching turns on for a prompt once it grows past it.
+CLAUDE_CACHE_MIN_TOKENS = int(os.getenv("CLAUDE_CACHE_MIN_TOKENS", "1024"))
+_CACHED = {"type": "ephemeral"}
+
+
+def _system(prompt: str):
+    block = {"type": "text", "text": prompt}
+    if estimate_tokens(prompt) >= CLAUDE_CACHE_MIN_TOKENS:
+        block["cache_control"] = _CACHED
+    return [block]
+
+
+def _cacheable(system) -> bool:
+    return isinstance(system, list) and any("cache_control" in block for block in system)
+
+
+def _messages_api(system):
+    # the pinned SDK only sends cache_control, and reports cache reads and
+    # writes, through the prompt caching beta
+    return client.beta.prompt_caching.messages if _cacheable(system) else client.messages
+
+
+RECOMMENDATION_SYSTEM = _system(CONSEQUENCES_PROMPT)
+NUTRITION_SYSTEM = _system(NUTRITION_FACTS_PLEASE_PROMPT)
+
+_BATCHES_HEADERS = {
+    "anthropic-beta": ",".join(
+        ["message-batches-2024-09-24"]
+        + (["prompt-caching-2024-07-31"] if _cacheable(NUTRITION_SYSTEM) else [])
+    )
+}
+
+
+def record_usage(label: str, usage):
+    """
+    Logs a call's token counts, including those read from and written to
+    the prompt cache (0 for calls without a cache breakpoint).
+    """
+    logger.info(
+        "%s: %d input tokens, %d read from cache, %d written to cache, %d output tokens",
+        label,
+        usage.input_tokens,
+        getattr(usage, "cache_read_input_tokens", None) or 0,
+        getattr(usage, "cache_creation_input_tokens", None) or 0,
+        usage.output_tokens,
+    )
+
+
+async def create_message(messages, max_tokens=1024, system=anthropic.NOT_GIVEN, **kwargs):
+    """
+    messages.create on the shared AsyncAnthropic client, bounded by
+    CLAUDE_CONCURRENCY. Goes through the prompt caching beta when the
+    system prompt has a cache breakpoint.
+    """
+    async with _slots:
+        return await _messages_api(system).create(
+            model=CLAUDE_MODEL, max_tokens=max_tokens, messages=messages, system=system, **kwargs
+        )
+
+
+def message_text(message) -> str:
+    return "".join(chain.from_iterable(block.text for block in message.content))
+
+
+def _nutrition_messages(image: bytes, media_type: str):
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": base64.b64encode(image).decode("utf-8"),
+                    },
+                },
+            ],
+        }
+    ]
+
+
+async def estimate_nutrition(image: bytes, media_type: str) -> str:
+    """
+    Asks Claude for the nutrition facts of the food in the image.
+
+    :return: Raw model output, expected to be the JSON object described by NUTRITION_FACTS_PLEASE_PROMPT
+    """
+    message = await create_message(
+        _nutrition_messages(image, media_type), system=NUTRITION_SYSTEM
+    )
+    record_usage("estimate_nutrition", message.usage)
+    return message_text(message)
+
+
+async def create_nutrition_batch(images) -> dict:
+    """
+    Submits estimate_nutrition requests through the Message Batches API,
+    which answers within 24 hours at half the price. The pinned SDK predates
+    batches, so this goes through the client's raw HTTP methods.
+
+    :param images: (custom_id, image bytes, media type) tuples
+    :return: The created message batch object
+    """
+    return await client.post(
+        "/v1/messages/batches",
+        body={
+            "requests": [
+                {
+                    "custom_id": custom_id,
+                    "params": {
+                        "model": CLAUDE_MODEL,
+                        "max_tokens": 1024,
+                        "system": NUTRITION_SYSTEM,
+                        "messages": _nutrition_messages(image, media_type),
+                    },
+                }
+                for custom_id, image, media_type in images
+            ]
+        },
+        cast_to=object,
+        options={"headers": _BATCHES_HEADERS},
+    )
+
+
+async def get_batch(batch_id: str) -> dict:
+    return await client.get(
+        f"/v1/messages/batches/{batch_id}",
+        cast_to=object,
+        options={"headers": _BATCHES_HEADERS},
+    )
+
+
+async def batch_results(batch: dict) -> dict:
+    """
+    :return: custom_id -> result object ({"type": "succeeded", "message": ...} or an error) of an ended batch
+    """
+    response = await client.get(
+        batch["results_url"], cast_to=httpx.Response, options={"headers": _BATCHES_HEADERS}
+    )
+    results = {}
+    for line in response.text.splitlines():
+        if line.strip():
+            entry = json.loads(line)
+            results[entry["custom_id"]] = entry["result"]
+    return results
+
+
+async def recommend(prompt: str) -> str:
+    """
+    :param prompt: Per-event part of the prompt, see crud.generate_consequences_prompt
+    """
+    message = await create_message(
+        [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt,
+                    }
+                ],
+            }
+        ],
+        system=RECOMMENDATION_SYSTEM,
+    )
+    record_usage("recommend", message.usage)
+    return message_text(message)
+
+
+async def stream_recommendation(prompt: str):
+    """
+    Same request as recommend, yielding the text as Claude generates it.
+    """
+    async with _slots:
+        async with _messages_api(RECOMMENDATION_SYSTEM).stream(
+            model=CLAUDE_MODEL,
+            max_tokens=1024,
+            messages=[{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+            system=RECOMMENDATION_SYSTEM,
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            record_usage("stream_recommendation", (await stream.get_final_message()).usage)
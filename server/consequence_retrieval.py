@@ -0,0 +1,183 @@
+import math
+import os
+import re
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from models import EventConsequence
+
+# past consequences put in the recommendation prompt, at most
+CONSEQUENCE_TOP_K = int(os.getenv("CONSEQUENCE_TOP_K", "20"))
+# rough token budget for those lines, at ~4 characters per token
+CONSEQUENCE_TOKEN_BUDGET = int(os.getenv("CONSEQUENCE_TOKEN_BUDGET", "2000"))
+
+TYPE_WEIGHT = 1.0
+NUTRIENT_WEIGHT = 1.0
+DESCRIPTION_WEIGHT = 1.0
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def _tokens(text: Optional[str]) -> frozenset:
+    return frozenset(_TOKEN.findall(text.lower())) if text else frozenset()
+
+
+def numeric_values(data) -> dict:
+    """
+    Numeric leaves of the event data keyed by their own name, so
+    {"data": {"carbohydrate": 40}} and {"carbohydrate": 40} line up.
+    """
+    nutrients = {}
+    if isinstance(data, dict):
+        for key, value in data.items():
+            name = str(key).lower()
+            if isinstance(value, dict):
+                nutrients.update(numeric_values(value))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                nutrients[name] = float(value)
+    return nutrients
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class _Entry(NamedTuple):
+    line: str
+    type: str
+    tokens: frozenset
+    nutrients: dict
+
+
+class ConsequenceIndex:
+    """
+    The event_consequences table, preprocessed for similarity lookups: one
+    row per consequence in a log-scaled nutrient matrix, plus its event type
+    and description tokens. Built for one version of the table (see
+    crud.get_event_consequences_version) and replaced, not mutated, when the
+    table changes.
+    """
+
+    def __init__(self, version, entries: List[_Entry], max_id: Optional[int]):
+        self.version = version
+        self.entries = entries
+        self.max_id = max_id
+        self.types = np.array([entry.type for entry in entries], dtype=object)
+        self.columns = sorted({name for entry in entries for name in entry.nutrients})
+        column_index = {name: i for i, name in enumerate(self.columns)}
+        self.matrix = np.zeros((len(entries), len(self.columns)))
+        self.has_nutrients = np.zeros(len(entries), dtype=bool)
+        for row, entry in enumerate(entries):
+            for name, value in entry.nutrients.items():
+                self.matrix[row, column_index[name]] = value
+            self.has_nutrients[row] = bool(entry.nutrients)
+        # grams and milligrams differ by orders of magnitude, compare on a log scale
+        self.matrix = np.log1p(np.abs(self.matrix))
+
+    def _vector(self, nutrients: dict) -> np.ndarray:
+        vector = np.zeros(len(self.columns))
+        for i, name in enumerate(self.columns):
+            vector[i] = nutrients.get(name, 0.0)
+        return np.log1p(np.abs(vector))
+
+    def scores(self, type: str, description: Optional[str], data) -> np.ndarray:
+        scores = TYPE_WEIGHT * (self.types == type).astype(float)
+
+        nutrients = numeric_values(data)
+        if nutrients and self.columns:
+            distance = np.linalg.norm(self.matrix - self._vector(nutrients), axis=1)
+            similarity = np.exp(-distance / math.sqrt(len(self.columns)))
+            scores += NUTRIENT_WEIGHT * np.where(self.has_nutrients, similarity, 0.0)
+
+        tokens = _tokens(description)
+        if tokens:
+            scores += DESCRIPTION_WEIGHT * np.fromiter(
+                (
+                    len(tokens & entry.tokens) / len(tokens | entry.tokens)
+                    for entry in self.entries
+                ),
+                dtype=float,
+                count=len(self.entries),
+            )
+        return scores
+
+    def top_lines(
+        self,
+        type: str,
+        description: Optional[str],
+        data,
+        k: int = CONSEQUENCE_TOP_K,
+        token_budget: int = CONSEQUENCE_TOKEN_BUDGET,
+    ) -> List[str]:
+        """
+        "<event> -> <consequence>" lines of the k most similar past events,
+        best first, stopping before the token budget would be exceeded.
+        """
+        if not self.entries or k <= 0:
+            return []
+        scores = self.scores(type, description, data)
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+
+        lines = []
+        used = 0
+        for row in best:
+            line = self.entries[row].line
+            cost = estimate_tokens(line)
+            if used + cost > token_budget:
+                break
+            lines.append(line)
+            used += cost
+        return lines
+
+
+def _entries(rows) -> List[_Entry]:
+    return [
+        _Entry(
+            line=f"{event} -> {consequence}",
+            type=(event or {}).get("type"),
+            tokens=_tokens((event or {}).get("description")),
+            nutrients=numeric_values((event or {}).get("data")),
+        )
+        for event, consequence in rows
+    ]
+
+
+_index = ConsequenceIndex(None, [], None)
+
+
+def consequence_index(db: Session, version: Tuple[int, Optional[int]]) -> ConsequenceIndex:
+    """
+    The index for the given version of event_consequences. Consequences are
+    only ever appended, so usually only rows past the last indexed id are
+    read; anything else rebuilds from scratch.
+    """
+    global _index
+    current = _index
+    if current.version == version:
+        return current
+
+    count, max_id = version
+    entries = None
+    if current.version is not None and current.max_id is not None:
+        rows = (
+            db.query(EventConsequence.id, EventConsequence.event, EventConsequence.consequence)
+            .filter(EventConsequence.id > current.max_id)
+            .order_by(EventConsequence.id)
+            .all()
+        )
+        if len(current.entries) + len(rows) == count:
+            entries = current.entries + _entries((event, text) for _, event, text in rows)
+    if entries is None:
+        rows = (
+            db.query(EventConsequence.event, EventConsequence.consequence)
+            .order_by(EventConsequence.id)
+            .all()
+        )
+        entries = _entries(rows)
+
+    _index = ConsequenceIndex(version, entries, max_id)
+    return _index
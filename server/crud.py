@@ -1,11 +1,27 @@
 from datetime import datetime
 from datetime import datetime
+import asyncio
+import io
 from fastapi import FastAPI, Depends, HTTPException, Query, UploadFile, File
 from itertools import chain
-from models import EventConsequence, GlucoseReading, TimeSeriesEvent
+from consequence_retrieval import consequence_index, numeric_values
+from detection import (
+    DEFAULT_THRESHOLDS,
+    EXCURSION_TYPES,
+    RATE_EXCURSION_TYPES,
+    open_time_ranges_of_interest_arrays,
+    time_ranges_of_interest_arrays,
+)
+from models import AgentThread, EventConsequence, GlucoseExcursion, GlucoseReading, ImageEstimate, TimeSeriesEvent
 from requests2 import GlucoseCreate, TimeSeriesEventCreate
+from sqlalchemy import String, case, cast, delete, func, insert, or_, select, text
+from sqlalchemy.dialects.postgresql import BIT, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import List, Optional, Union
+from sqlalchemy.util import await_only
+from typing import Iterable, Iterator, List, Literal, Optional, Tuple, Union
+import asyncpg
+import numpy as np
 
 from langchain_core.callbacks import (
     AsyncCallbackManagerForToolRun,
@@ -40,6 +56,8 @@ def create_glucose(db: Session, glucose: GlucoseCreate):
         glucose_value=glucose.glucose_value,
     )
     db.add(db_glucose)
+    db.flush()
+    refresh_glucose_excursions(db, since=glucose.timestamp)
     db.commit()
     db.refresh(db_glucose)
     return db_glucose
@@ -54,8 +72,93 @@ def create_glucose_batch(db: Session, glucose_records: list[GlucoseCreate]):
         for record in glucose_records
     ]
     db.bulk_save_objects(db_glucose_list)
+    if db_glucose_list:
+        db.flush()
+        refresh_glucose_excursions(
+            db, since=min(reading.timestamp for reading in db_glucose_list)
+        )
+    db.commit()
+
+
+def upsert_glucose_rows(
+    db: Session,
+    rows: Iterable[Tuple[datetime, int]],
+    on_conflict: Literal["nothing", "update"] = "nothing",
+):
+    """
+    Loads (timestamp, glucose_value) rows into a staging table with COPY and
+    merges them into glucose_readings with INSERT ... ON CONFLICT, so
+    overlapping uploads don't abort the batch. Readings that already exist
+    are skipped, or overwritten with on_conflict="update".
+
+    :return: Dictionary with counts of received, inserted, updated and skipped rows
+    """
+    # a timestamp repeated within the upload keeps its last value
+    latest = {}
+    received = 0
+    for timestamp, glucose_value in rows:
+        latest[timestamp] = int(glucose_value)
+        received += 1
+
+    buffer = io.StringIO()
+    for timestamp, glucose_value in latest.items():
+        buffer.write(f"{timestamp.isoformat()},{glucose_value}\n")
+    buffer.seek(0)
+
+    db.execute(
+        text(
+            "CREATE TEMP TABLE IF NOT EXISTS glucose_readings_staging "
+            "(timestamp timestamp NOT NULL, glucose_value integer NOT NULL) "
+            "ON COMMIT DELETE ROWS"
+        )
+    )
+    db.execute(text("TRUNCATE glucose_readings_staging"))
+    driver_connection = db.connection().connection.driver_connection
+    if isinstance(driver_connection, asyncpg.Connection):
+        # called through AsyncSession.run_sync, we're inside its greenlet
+        await_only(
+            driver_connection.copy_to_table(
+                "glucose_readings_staging",
+                source=io.BytesIO(buffer.getvalue().encode()),
+                columns=["timestamp", "glucose_value"],
+                format="csv",
+            )
+        )
+    else:
+        driver_connection.cursor().copy_expert(
+            "COPY glucose_readings_staging (timestamp, glucose_value) FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+
+    if on_conflict == "update":
+        conflict = (
+            "DO UPDATE SET glucose_value = EXCLUDED.glucose_value "
+            "WHERE glucose_readings.glucose_value IS DISTINCT FROM EXCLUDED.glucose_value"
+        )
+    else:
+        conflict = "DO NOTHING"
+    # xmax is 0 for freshly inserted rows and set for rows the upsert updated
+    changed = db.execute(
+        text(
+            "INSERT INTO glucose_readings (timestamp, glucose_value) "
+            "SELECT timestamp, glucose_value FROM glucose_readings_staging "
+            f"ON CONFLICT (timestamp) {conflict} "
+            "RETURNING timestamp, xmax = 0"
+        )
+    ).all()
+
+    if changed:
+        refresh_glucose_excursions(db, since=min(timestamp for timestamp, _ in changed))
     db.commit()
 
+    inserted = sum(1 for _, is_insert in changed if is_insert)
+    return {
+        "received": received,
+        "inserted": inserted,
+        "updated": len(changed) - inserted,
+        "skipped": received - len(changed),
+    }
+
 
 def get_glucose(db: Session):
     return db.query(GlucoseReading).all()
@@ -65,6 +168,262 @@ def get_glucose_since(db: Session, timestamp: int):
     return db.query(GlucoseReading).filter(GlucoseReading.timestamp >= timestamp).all()
 
 
+# rows fetched per round trip from the server-side cursor
+GLUCOSE_FETCH_CHUNK_SIZE = 5000
+
+
+def glucose_rows_query(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """
+    (timestamp, glucose_value) rows in [start, end] ordered by timestamp,
+    without building ORM objects.
+    """
+    stmt = select(GlucoseReading.timestamp, GlucoseReading.glucose_value)
+
+    if start:
+        stmt = stmt.where(GlucoseReading.timestamp >= start)
+    if end:
+        stmt = stmt.where(GlucoseReading.timestamp <= end)
+
+    return stmt.order_by(GlucoseReading.timestamp)
+
+
+def stream_glucose_rows(
+    db: Session,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    chunk_size: int = GLUCOSE_FETCH_CHUNK_SIZE,
+) -> Iterator[list]:
+    """
+    Yields chunks of glucose_rows_query rows straight from a server-side cursor.
+    """
+    stmt = glucose_rows_query(start, end).execution_options(
+        stream_results=True, yield_per=chunk_size
+    )
+    yield from db.execute(stmt).partitions()
+
+
+def glucose_records(chunks: Iterable[list]) -> List[dict]:
+    """
+    Chunks of glucose rows as JSON-ready dicts, without validating a
+    GlucoseCreate per reading.
+    """
+    return [
+        {"timestamp": timestamp.isoformat(), "glucose_value": glucose_value}
+        for chunk in chunks
+        for timestamp, glucose_value in chunk
+    ]
+
+
+def glucose_arrays(chunks: Iterable[list]):
+    """
+    Chunks of glucose rows as a list of timestamps and a parallel int64
+    array of values, ready for detection.time_ranges_of_interest_arrays.
+    """
+    timestamps = []
+    values = []
+    for chunk in chunks:
+        timestamps.extend(row[0] for row in chunk)
+        values.append(np.fromiter((row[1] for row in chunk), dtype=np.int64, count=len(chunk)))
+
+    return timestamps, np.concatenate(values) if values else np.empty(0, dtype=np.int64)
+
+
+def get_glucose_records(
+    db: Session, start: Optional[datetime] = None, end: Optional[datetime] = None
+):
+    """
+    Glucose readings in [start, end] as JSON-ready dicts.
+    """
+    return glucose_records(stream_glucose_rows(db, start=start, end=end))
+
+
+def get_glucose_arrays(
+    db: Session, start: Optional[datetime] = None, end: Optional[datetime] = None
+):
+    """
+    Glucose readings in [start, end] as timestamps and values, see glucose_arrays.
+    """
+    return glucose_arrays(stream_glucose_rows(db, start=start, end=end))
+
+
+async def fetch_glucose_records(
+    db: AsyncSession, start: Optional[datetime] = None, end: Optional[datetime] = None
+):
+    """
+    get_glucose_records on an AsyncSession. The query runs on the event loop
+    and the rows are turned into records in a worker thread, so a long
+    window doesn't hold up other requests.
+    """
+    result = await db.execute(glucose_rows_query(start, end))
+    return await asyncio.to_thread(
+        glucose_records, result.partitions(GLUCOSE_FETCH_CHUNK_SIZE)
+    )
+
+
+# advisory lock key serializing refresh_glucose_excursions
+GLUCOSE_EXCURSIONS_LOCK = 0x676C7563
+
+
+def refresh_glucose_excursions(db: Session, since: Optional[datetime] = None):
+    """
+    Re-derives the materialized glucose_excursions rows affected by readings
+    at or after `since`. Excursions that ended before then are left alone, so
+    appending new readings only re-evaluates the tail. since=None rebuilds
+    the whole table. The caller commits.
+    """
+    # concurrent ingests would each delete and re-insert the same tail without
+    # seeing the other's rows; held until the caller's transaction ends
+    db.execute(
+        text("SELECT pg_advisory_xact_lock(:key)"), {"key": GLUCOSE_EXCURSIONS_LOCK}
+    )
+
+    resume = None
+    if since is not None:
+        # the reading before `since` decides whether a rate-of-change range
+        # starts there, so the re-evaluation has to include it
+        resume = db.execute(
+            select(func.max(GlucoseReading.timestamp)).where(
+                GlucoseReading.timestamp < since
+            )
+        ).scalar() or since
+
+        # move back to the start of anything still in progress at resume,
+        # otherwise it would be split in two
+        while True:
+            straddling_start = db.execute(
+                select(func.min(GlucoseExcursion.start)).where(
+                    GlucoseExcursion.start < resume,
+                    or_(GlucoseExcursion.end.is_(None), GlucoseExcursion.end > resume),
+                )
+            ).scalar()
+            if straddling_start is None:
+                break
+            resume = straddling_start
+
+    stale = delete(GlucoseExcursion)
+    if resume is not None:
+        stale = stale.where(GlucoseExcursion.start >= resume)
+    db.execute(stale)
+
+    timestamps, values = get_glucose_arrays(db, start=resume)
+    ranges = open_time_ranges_of_interest_arrays(timestamps, values, **DEFAULT_THRESHOLDS)
+    rows = [
+        {
+            "type": type,
+            "start": start,
+            "end": end,
+            "threshold": DEFAULT_THRESHOLDS[f"{type}_threshold"],
+        }
+        for type, type_ranges in ranges.items()
+        for start, end in type_ranges
+    ]
+    if rows:
+        db.execute(insert(GlucoseExcursion), rows)
+
+
+def _window_readings_query(start: datetime, end: Optional[datetime] = None):
+    # the first two readings of the window
+    stmt = select(GlucoseReading.timestamp).where(GlucoseReading.timestamp >= start)
+    if end:
+        stmt = stmt.where(GlucoseReading.timestamp <= end)
+    return stmt.order_by(GlucoseReading.timestamp).limit(2)
+
+
+def _excursions_query(first: Optional[datetime] = None, end: Optional[datetime] = None):
+    query = select(
+        GlucoseExcursion.type, GlucoseExcursion.start, GlucoseExcursion.end
+    ).where(GlucoseExcursion.end.is_not(None))
+
+    if first:
+        # an excursion has to close after the window's first reading to show up in it
+        query = query.where(GlucoseExcursion.end > first)
+    if end:
+        query = query.where(GlucoseExcursion.end <= end)
+    return query.order_by(GlucoseExcursion.start)
+
+
+def _excursion_ranges(rows, first: Optional[datetime] = None, second: Optional[datetime] = None):
+    ranges = {type: [] for type in EXCURSION_TYPES}
+    for type, range_start, range_end in rows:
+        if first is not None:
+            # a rate of change range closes one reading after its last jump,
+            # which has to be between two readings of the window
+            if type in RATE_EXCURSION_TYPES and (second is None or range_end <= second):
+                continue
+            range_start = max(range_start, first)
+        ranges[type].append((range_start, range_end))
+    return ranges
+
+
+def get_glucose_excursions(
+    db: Session, start: Optional[datetime] = None, end: Optional[datetime] = None
+):
+    """
+    Materialized excursions in the same shape as
+    detection.time_ranges_of_interest on the readings in [start, end]: those
+    closing inside the window, with any that began before it starting at the
+    window's first reading. Excursions still in progress at the window's end
+    are left out, as they are by the on-the-fly detection.
+    """
+    first = second = None
+    if start:
+        readings = db.scalars(_window_readings_query(start, end)).all()
+        if not readings:
+            return {type: [] for type in EXCURSION_TYPES}
+        first, second = (readings + [None])[:2]
+    return _excursion_ranges(db.execute(_excursions_query(first, end)), first, second)
+
+
+def _is_default(thresholds) -> bool:
+    return {**DEFAULT_THRESHOLDS, **thresholds} == DEFAULT_THRESHOLDS
+
+
+def get_time_ranges_of_interest(
+    db: Session,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    **thresholds,
+):
+    """
+    Serves the default thresholds from glucose_excursions, anything else is
+    computed from the readings in [start, end].
+    """
+    if _is_default(thresholds):
+        return get_glucose_excursions(db, start=start, end=end)
+
+    timestamps, values = get_glucose_arrays(db, start=start, end=end)
+    return time_ranges_of_interest_arrays(timestamps, values, **thresholds)
+
+
+async def fetch_time_ranges_of_interest(
+    db: AsyncSession,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    **thresholds,
+):
+    """
+    get_time_ranges_of_interest on an AsyncSession, with the queries on the
+    event loop and the rows turned into ranges in a worker thread.
+    """
+    if _is_default(thresholds):
+        first = second = None
+        if start:
+            readings = (await db.scalars(_window_readings_query(start, end))).all()
+            if not readings:
+                return {type: [] for type in EXCURSION_TYPES}
+            first, second = (readings + [None])[:2]
+        result = await db.execute(_excursions_query(first, end))
+        return await asyncio.to_thread(_excursion_ranges, result, first, second)
+
+    result = await db.execute(glucose_rows_query(start, end))
+
+    def detect():
+        timestamps, values = glucose_arrays(result.partitions(GLUCOSE_FETCH_CHUNK_SIZE))
+        return time_ranges_of_interest_arrays(timestamps, values, **thresholds)
+
+    return await asyncio.to_thread(detect)
+
+
 def create_time_series_event(db: Session, event: TimeSeriesEventCreate):
     db_event = TimeSeriesEvent(
         type=event.type,
@@ -78,6 +437,34 @@ def create_time_series_event(db: Session, event: TimeSeriesEventCreate):
     return db_event
 
 
+def create_time_series_events(db: Session, events: List[TimeSeriesEventCreate]):
+    """
+    Inserts all events in one transaction with a multi-row
+    INSERT ... RETURNING, returning the created rows in input order. The
+    rows are detached before the commit, so they keep their loaded values
+    whatever the session's expire_on_commit.
+    """
+    if not events:
+        return []
+
+    db_events = db.scalars(
+        insert(TimeSeriesEvent).returning(TimeSeriesEvent, sort_by_parameter_order=True),
+        [
+            {
+                "type": event.type,
+                "timestamp": event.timestamp,
+                "data": event.data,
+                "description": event.description,
+            }
+            for event in events
+        ],
+    ).all()
+    for db_event in db_events:
+        db.expunge(db_event)
+    db.commit()
+    return db_events
+
+
 def get_time_series_events_by_type(
     db: Session, type: str, skip: int = 0, limit: int = 100
 ):
@@ -110,36 +497,197 @@ def get_time_series_events(
     return query.offset(skip).limit(limit).all()
 
 
+def _events_in_range_query(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    query = select(TimeSeriesEvent)
+
+    if start:
+        query = query.where(TimeSeriesEvent.timestamp >= start)
+    if end:
+        query = query.where(TimeSeriesEvent.timestamp <= end)
+
+    return query.order_by(TimeSeriesEvent.timestamp)
+
+
+def get_time_series_events_in_range(
+    db: Session, start: Optional[datetime] = None, end: Optional[datetime] = None
+):
+    return db.scalars(_events_in_range_query(start, end)).all()
+
+
+async def fetch_time_series_events_in_range(
+    db: AsyncSession, start: Optional[datetime] = None, end: Optional[datetime] = None
+):
+    """
+    get_time_series_events_in_range on an AsyncSession, building the ORM
+    objects in a worker thread.
+    """
+    result = await db.execute(_events_in_range_query(start, end))
+    return await asyncio.to_thread(lambda: result.scalars().all())
+
+
+def _combined_queries(input_data: CombinedDataInput):
+    """
+    :return: The glucose rows query (None if glucose isn't asked for) and the events query
+    """
+    events_query = select(TimeSeriesEvent).where(
+        TimeSeriesEvent.timestamp >= input_data.start,
+        TimeSeriesEvent.timestamp <= input_data.end,
+    )
+
+    include_glucose = True
+    if input_data.type:
+        include_glucose = "glucose" in input_data.type
+        events_query = events_query.where(TimeSeriesEvent.type.in_(input_data.type))
+
+    glucose_query = glucose_rows_query(input_data.start, input_data.end) if include_glucose else None
+    return glucose_query, events_query
+
+
+def _combine(glucose_chunks: Iterable[list], events: Iterable[TimeSeriesEvent]):
+    glucose_data = [row._asdict() for chunk in glucose_chunks for row in chunk]
+    return sorted(
+        chain(glucose_data, events),
+        key=lambda x: x["timestamp"] if isinstance(x, dict) else x.timestamp,
+    )
+
+
 def combined_data_query(
     input_data: CombinedDataInput,
-) -> List[Union[GlucoseReading, TimeSeriesEvent]]:
+    db: Optional[Session] = None,
+) -> List[Union[dict, TimeSeriesEvent]]:
 
-    db = SessionLocal()
-    glucose_query = db.query(GlucoseReading)
-    events_query = db.query(TimeSeriesEvent)
+    if db is None:
+        with SessionLocal() as db:
+            return combined_data_query(input_data, db=db)
 
-    glucose_query = glucose_query.filter(GlucoseReading.timestamp >= input_data.start)
-    events_query = events_query.filter(TimeSeriesEvent.timestamp >= input_data.start)
+    glucose_query, events_query = _combined_queries(input_data)
+    glucose_chunks = []
+    if glucose_query is not None:
+        glucose_chunks = db.execute(
+            glucose_query.execution_options(stream_results=True, yield_per=GLUCOSE_FETCH_CHUNK_SIZE)
+        ).partitions()
+    return _combine(glucose_chunks, db.scalars(events_query).all())
 
-    glucose_query = glucose_query.filter(GlucoseReading.timestamp <= input_data.end)
-    events_query = events_query.filter(TimeSeriesEvent.timestamp <= input_data.end)
 
-    if input_data.type:
-        if "glucose" not in input_data.type:
-            glucose_query = glucose_query.filter(False)
-        events_query = events_query.filter(TimeSeriesEvent.type.in_(input_data.type))
+async def fetch_combined_data(db: AsyncSession, input_data: CombinedDataInput):
+    """
+    combined_data_query on an AsyncSession, with the queries on the event
+    loop and the rows merged in a worker thread.
+    """
+    glucose_query, events_query = _combined_queries(input_data)
+    glucose = await db.execute(glucose_query) if glucose_query is not None else None
+    events = await db.execute(events_query)
+    return await asyncio.to_thread(
+        lambda: _combine(
+            glucose.partitions(GLUCOSE_FETCH_CHUNK_SIZE) if glucose is not None else [],
+            events.scalars().all(),
+        )
+    )
 
-    # glucose_query = glucose_query.offset(input_data.skip).limit(input_data.limit)
-    # events_query = events_query.offset(input_data.skip).limit(input_data.limit)
-    glucose_data = glucose_query.all()
-    events_data = events_query.all()
 
-    combined_data = sorted(
-        chain(glucose_data, events_data),
-        key=lambda x: x.timestamp if hasattr(x, "timestamp") else x.timestamp,
+def get_hourly_glucose_summary(
+    db: Session,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    low: int = DEFAULT_THRESHOLDS["hypoglycemic_threshold"],
+    high: int = DEFAULT_THRESHOLDS["hyperglycemic_threshold"],
+) -> List[dict]:
+    """
+    Glucose in [start, end] aggregated per hour by the database: mean, min,
+    max, number of readings and the percentage of them within [low, high].
+    """
+    hour = func.date_trunc("hour", GlucoseReading.timestamp).label("hour")
+    value = GlucoseReading.glucose_value
+    in_range = case((value.between(low, high), 100.0), else_=0.0)
+    query = select(
+        hour, func.avg(value), func.min(value), func.max(value), func.count(), func.avg(in_range)
     )
+    if start:
+        query = query.where(GlucoseReading.timestamp >= start)
+    if end:
+        query = query.where(GlucoseReading.timestamp <= end)
+
+    return [
+        {
+            "hour": hour.strftime("%Y-%m-%d %H:00"),
+            "mean": round(float(mean), 1),
+            "min": minimum,
+            "max": maximum,
+            "readings": readings,
+            "time_in_range_pct": round(float(time_in_range), 1),
+        }
+        for hour, mean, minimum, maximum, readings, time_in_range in db.execute(
+            query.group_by(hour).order_by(hour)
+        )
+    ]
+
 
-    return combined_data
+def summarize_events_by_day(events: Iterable[TimeSeriesEvent]) -> List[dict]:
+    """
+    One entry per day and event type: how many there were, their distinct
+    descriptions and the totals of the numbers in their data (carbohydrate,
+    insulin units, ...).
+    """
+    days = {}
+    for event in events:
+        key = (event.timestamp.strftime("%Y-%m-%d"), event.type)
+        day = days.setdefault(
+            key,
+            {"date": key[0], "type": key[1], "count": 0, "descriptions": [], "totals": {}},
+        )
+        day["count"] += 1
+        if event.description and event.description not in day["descriptions"]:
+            day["descriptions"].append(event.description)
+        for name, amount in numeric_values(event.data).items():
+            day["totals"][name] = round(day["totals"].get(name, 0) + amount, 2)
+    return list(days.values())
+
+
+def summarize_combined_data(
+    input_data: CombinedDataInput, raw: bool = False, db: Optional[Session] = None
+) -> dict:
+    """
+    What combined_data_query returns, condensed for a model's context:
+    hourly glucose aggregates and per-day event summaries. The individual
+    readings and events are only included, as "raw", when asked for.
+    """
+    if db is None:
+        with SessionLocal() as db:
+            return summarize_combined_data(input_data, raw=raw, db=db)
+
+    types = input_data.type or []
+    include_glucose = not types or "glucose" in types
+    events_query = db.query(TimeSeriesEvent).filter(
+        TimeSeriesEvent.timestamp >= input_data.start,
+        TimeSeriesEvent.timestamp <= input_data.end,
+    )
+    if types:
+        events_query = events_query.filter(TimeSeriesEvent.type.in_(types))
+    events = events_query.order_by(TimeSeriesEvent.timestamp).all()
+
+    summary = {
+        "glucose_hourly": get_hourly_glucose_summary(db, input_data.start, input_data.end)
+        if include_glucose
+        else [],
+        "events_daily": summarize_events_by_day(events),
+    }
+    if raw:
+        summary["raw"] = [
+            {
+                "timestamp": str(row["timestamp"]),
+                "type": "glucose",
+                "glucose_value": row["glucose_value"],
+            }
+            if isinstance(row, dict)
+            else {
+                "timestamp": str(row.timestamp),
+                "type": row.type,
+                "description": row.description,
+                "data": row.data,
+            }
+            for row in combined_data_query(input_data, db=db)
+        ]
+    return summary
 
 
 def create_event_consequence(
@@ -157,52 +705,111 @@ def create_event_consequence(
     return db_consequence
 
 
+def get_event_consequences_version(db: Session):
+    """
+    Changes whenever a consequence is added or removed, so anything derived
+    from the event_consequences table can tell when it is stale.
+    """
+    return tuple(
+        db.query(func.count(EventConsequence.id), func.max(EventConsequence.id)).one()
+    )
+
+
 def generate_consequences_prompt(event: TimeSeriesEventCreate, db: Session) -> str:
-    all_consequences = db.query(EventConsequence).all()
+    """
+    Per-event part of the recommendation prompt: the past consequences most
+    similar to the event (see consequence_retrieval) and the event itself.
+    The instructions are static and sent separately, as
+    prompts.CONSEQUENCES_PROMPT.
+    """
+    index = consequence_index(db, get_event_consequences_version(db))
+    similar_consequences = index.top_lines(event.type, event.description, event.data)
 
-    preamble = """
-    You are a diabetes specialist and are being given data from a patient of yours.
-    The data consists of a series of events and their consequences.
+    consequences = "\n".join(similar_consequences)
 
-    For example, an event might be a patient eating a meal, and the consequence might be hyperglycemia.
+    event = f"event in question: {event}"
+    return f"{consequences}\n{event}"
 
-    consequences are structured as follows:
+def get_image_estimate(db: Session, key: str):
+    estimate = db.get(ImageEstimate, key)
+    return estimate.result if estimate else None
 
-    <JSON event data> -> <consequence>
 
-    Given the list of consequences below, as well as the event in question, please select the most likely consequence,
-    and make a recommendation to the patient based on that consequence. You should also provide a brief explanation of your reasoning.
+def find_similar_image_estimate(
+    db: Session, variant: str, perceptual_hash: int, max_distance: int
+):
+    """
+    Result of the stored image whose perceptual hash is closest to
+    `perceptual_hash`, if it is within `max_distance` differing bits.
+    """
+    # number of set bits in the XOR, i.e. the Hamming distance
+    differing_bits = cast(ImageEstimate.perceptual_hash.op("#")(perceptual_hash), BIT(64))
+    distance = func.length(func.replace(cast(differing_bits, String), "0", ""))
+    return db.execute(
+        select(ImageEstimate.result)
+        .where(
+            ImageEstimate.variant == variant,
+            ImageEstimate.perceptual_hash.is_not(None),
+            distance <= max_distance,
+        )
+        .order_by(distance)
+        .limit(1)
+    ).scalar()
 
-    Your response should be structured as only JSON of the following structure:
 
-    {
-        detail: string,
-        sources: string[]
-    }
-    detail should be no more than 3 sentences. You should start out detail similarly to the following:
+def create_image_estimate(
+    db: Session, key: str, variant: str, perceptual_hash: Optional[int], result: dict
+):
+    # an upsert, so concurrent uploads of the same photo don't collide
+    stmt = pg_insert(ImageEstimate).values(
+        key=key, variant=variant, perceptual_hash=perceptual_hash, result=result
+    )
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["key"],
+            set_={
+                "variant": stmt.excluded.variant,
+                # batch results come without a hash, keep the one we have
+                "perceptual_hash": func.coalesce(
+                    stmt.excluded.perceptual_hash, ImageEstimate.perceptual_hash
+                ),
+                "result": stmt.excluded.result,
+            },
+        )
+    )
+    db.commit()
 
-    "Based on your historical data, ______ will most likely result in ______. I recommend that you ______."
 
-    sources should be a string[] of examples of past events that support your recommendation. If you have no direct sources,
-    feel free to extrapolate based on other related events, or outside knowledge.
+def touch_agent_thread(db: Session, thread_id: str):
+    now = datetime.now()
+    db.execute(
+        pg_insert(AgentThread)
+        .values(thread_id=thread_id, last_active=now)
+        .on_conflict_do_update(index_elements=["thread_id"], set_={"last_active": now})
+    )
+    db.commit()
 
-    for example:
 
-    {
-        detail: "Based on your historical data, eating a meal will most likely result in hyperglycemia. I recommend that you take a walk after eating.",
-        sources: ["eating Sun-dried tomatoes on 2021-01-01 resulted in hyperglycemia"]
-    }
+def delete_idle_agent_threads(db: Session, before: datetime, limit: int = 1000) -> List[str]:
     """
+    Deletes up to `limit` threads last active before `before`, without
+    committing, so the caller can delete their checkpoints first.
 
-    consequences = "\n".join(
-        [
-            f"{consequence.event} -> {consequence.consequence}"
-            for consequence in all_consequences
-        ]
+    :return: Their thread ids, so their checkpoints can be deleted too
+    """
+    idle = (
+        select(AgentThread.thread_id)
+        .where(AgentThread.last_active < before)
+        .limit(limit)
+        .scalar_subquery()
     )
+    thread_ids = db.scalars(
+        delete(AgentThread)
+        .where(AgentThread.thread_id.in_(idle), AgentThread.last_active < before)
+        .returning(AgentThread.thread_id)
+    ).all()
+    return thread_ids
 
-    event = f"event in question: {event}"
-    return f"{preamble}\n{consequences}\n{event}"
 
 def delete_timeseries_event(db: Session, event_id: int):
     db.query(TimeSeriesEvent).filter(TimeSeriesEvent.id == event_id).delete()
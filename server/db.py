@@ -1,6 +1,7 @@
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 import os
 
 DB_USERNAME = os.getenv('DB_USERNAME')
@@ -9,6 +10,7 @@ DB_HOST = os.getenv('DB_HOST')
 DB_NAME = os.getenv('DB_NAME')
 
 DATABASE_URL = f"postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
 
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -20,3 +22,17 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# used by the async endpoints in main.py. requests wait on this pool rather
+# than on threadpool workers, so it bounds concurrent queries
+async_engine = create_async_engine(ASYNC_DATABASE_URL, pool_size=20, max_overflow=20)
+# objects returned from an endpoint are serialized after the commit, outside
+# of the session's greenlet, so they must not expire
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,5 +1,7 @@
+from bisect import bisect_left, bisect_right
 from datetime import timedelta
-from typing import List
+from typing import List, Sequence
+import numpy as np
 from models import GlucoseReading
 
 
@@ -109,6 +111,112 @@ def time_ranges_dropping_quickly(data: List[GlucoseReading], threshold):
     return quickly_dropping_ranges
 
 
+# start/end indices of every run of True in mask. a run that is still open at
+# the end of the data has a start but no end
+def _runs(mask: np.ndarray):
+    edges = np.diff(mask.astype(np.int8), prepend=np.int8(0))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _ranges(timestamps: Sequence, starts: np.ndarray, ends: np.ndarray):
+    if isinstance(timestamps, np.ndarray):
+        return list(zip(timestamps[starts].tolist(), timestamps[ends].tolist()))
+    # plain lists of datetimes are indexed directly, boxing them into an
+    # object array costs more than the whole detection pass
+    return [(timestamps[s], timestamps[e]) for s, e in zip(starts.tolist(), ends.tolist())]
+
+
+EXCURSION_TYPES = ("hyperglycemic", "hypoglycemic", "quickly_raising", "quickly_dropping")
+# the ones detected from the change between readings rather than their values
+RATE_EXCURSION_TYPES = ("quickly_raising", "quickly_dropping")
+
+# thresholds the /interesting-times/ and /interesting-events/ endpoints default to,
+# and the ones the glucose_excursions table is materialized at
+DEFAULT_THRESHOLDS = {
+    "hyperglycemic_threshold": 180,
+    "hypoglycemic_threshold": 70,
+    "quickly_raising_threshold": 2,
+    "quickly_dropping_threshold": 2,
+}
+
+
+# indices into the readings where each run of each range family starts and closes
+def _excursion_runs(
+    values,
+    hyperglycemic_threshold,
+    hypoglycemic_threshold,
+    quickly_raising_threshold,
+    quickly_dropping_threshold,
+):
+    values = np.asarray(values)
+    # threshold is in mg/dL/min. note sample data is in mg/dL/5min, so threshold is multiplied by 5
+    deltas = np.diff(values)
+
+    # a run over deltas starts at the reading before the first jump and
+    # closes at the reading after the last one
+    raise_starts, raise_ends = _runs(deltas > quickly_raising_threshold * 5)
+    drop_starts, drop_ends = _runs(-deltas > quickly_dropping_threshold * 5)
+
+    return {
+        "hyperglycemic": _runs(values > hyperglycemic_threshold),
+        "hypoglycemic": _runs(values < hypoglycemic_threshold),
+        "quickly_raising": (raise_starts, raise_ends + 1),
+        "quickly_dropping": (drop_starts, drop_ends + 1),
+    }
+
+
+# vectorized equivalent of time_ranges_of_interest. takes the readings as two
+# parallel sequences (sorted by timestamp) and computes all four range families
+# from a single pass over the values. timestamps can be a list of datetimes or
+# a datetime64 array
+def time_ranges_of_interest_arrays(
+    timestamps: Sequence,
+    values: Sequence[int],
+    hyperglycemic_threshold=180,
+    hypoglycemic_threshold=70,
+    quickly_raising_threshold=2,
+    quickly_dropping_threshold=2,
+):
+    runs = _excursion_runs(
+        values,
+        hyperglycemic_threshold,
+        hypoglycemic_threshold,
+        quickly_raising_threshold,
+        quickly_dropping_threshold,
+    )
+    # a range still open at the end of the data is dropped, same as the loops above
+    return {
+        type: _ranges(timestamps, starts[: len(ends)], ends)
+        for type, (starts, ends) in runs.items()
+    }
+
+
+# same as time_ranges_of_interest_arrays, except a range still open at the end
+# of the data is kept as (start, None) so later readings can close it
+def open_time_ranges_of_interest_arrays(
+    timestamps: Sequence,
+    values: Sequence[int],
+    hyperglycemic_threshold=180,
+    hypoglycemic_threshold=70,
+    quickly_raising_threshold=2,
+    quickly_dropping_threshold=2,
+):
+    runs = _excursion_runs(
+        values,
+        hyperglycemic_threshold,
+        hypoglycemic_threshold,
+        quickly_raising_threshold,
+        quickly_dropping_threshold,
+    )
+    ranges = {}
+    for type, (starts, ends) in runs.items():
+        ranges[type] = _ranges(timestamps, starts[: len(ends)], ends)
+        if len(starts) > len(ends):
+            open_start, _ = _ranges(timestamps, starts[-1:], starts[-1:])[0]
+            ranges[type].append((open_start, None))
+    return ranges
+
+
 # everything in mg/dL (or mg/dL/min).
 # note that each time range is likely caused by
 # an event ~20-30 minutes before the start of the range
@@ -119,20 +227,33 @@ def time_ranges_of_interest(
     quickly_raising_threshold=2,
     quickly_dropping_threshold=2,
 ):
-    hyperglycemic_ranges = time_ranges_hyperglycemic(data, hyperglycemic_threshold)
-    hypoglycemic_ranges = time_ranges_hypoglycemic(data, hypoglycemic_threshold)
-    quickly_raising_ranges = time_ranges_raising_quickly(
-        data, quickly_raising_threshold
+    timestamps = [reading.timestamp for reading in data]
+    values = np.fromiter(
+        (reading.glucose_value for reading in data), dtype=np.int64, count=len(data)
     )
-    quickly_dropping_ranges = time_ranges_dropping_quickly(
-        data, quickly_dropping_threshold
+    return time_ranges_of_interest_arrays(
+        timestamps,
+        values,
+        hyperglycemic_threshold=hyperglycemic_threshold,
+        hypoglycemic_threshold=hypoglycemic_threshold,
+        quickly_raising_threshold=quickly_raising_threshold,
+        quickly_dropping_threshold=quickly_dropping_threshold,
     )
-    return {
-        "hyperglycemic": hyperglycemic_ranges,
-        "hypoglycemic": hypoglycemic_ranges,
-        "quickly_raising": quickly_raising_ranges,
-        "quickly_dropping": quickly_dropping_ranges,
-    }
+
+# sorted timestamp index over events, so each window can be resolved with two
+# bisects instead of a scan over every event
+class EventIndex:
+    def __init__(self, events):
+        self.events = events
+        self.order = sorted(range(len(events)), key=lambda i: events[i].timestamp)
+        self.timestamps = [events[i].timestamp for i in self.order]
+
+    # events with start <= timestamp <= end, in the order they were given
+    def between(self, start, end):
+        lo = bisect_left(self.timestamps, start)
+        hi = bisect_right(self.timestamps, end)
+        return [self.events[i] for i in sorted(self.order[lo:hi])]
+
 
 # returns a dictionary of lists of interesting events
 # each list corresponds to a single time range, and contains
@@ -140,6 +261,7 @@ def time_ranges_of_interest(
 def interesting_events(times, events, lookback_minutes=20):
     interesting_events = {}
     window = timedelta(minutes=lookback_minutes)
+    index = EventIndex(events)
     for type, ranges in times.items():
         # subtract 20 minutes from the start and end of each time range
         t = [
@@ -150,7 +272,7 @@ def interesting_events(times, events, lookback_minutes=20):
         # find all events that occurred within the time range
         events_in_range = []
         for start, end in t:
-            hmmm = [event for event in events if start <= event.timestamp <= end]
+            hmmm = index.between(start, end)
             if hmmm:
                 events_in_range.append({
                     "range": (start + window, end + window),
@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+from typing import Optional
+
+from PIL import Image, UnidentifiedImageError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import claude
+import crud
+from cache import LRUCache
+from image_preprocessing import prepare_image
+from prompts import NUTRITION_FACTS_PLEASE_PROMPT
+
+# estimates kept in memory per worker, in front of the image_estimates table
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "256"))
+# perceptual hashes this many bits apart or fewer count as the same photo,
+# e.g. a retake of the same plate. 0 only reuses byte-identical uploads
+IMAGE_CACHE_MAX_DISTANCE = int(os.getenv("IMAGE_CACHE_MAX_DISTANCE", "0"))
+
+# content key -> (perceptual hash, estimate)
+_estimates = LRUCache(IMAGE_CACHE_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+def _sha256(*parts: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+# anything that changes the answer for the same image gets its own variant
+VARIANT = _sha256(claude.CLAUDE_MODEL.encode(), NUTRITION_FACTS_PLEASE_PROMPT.encode())
+
+
+def content_key(image: bytes) -> str:
+    return _sha256(VARIANT.encode(), image)
+
+
+def perceptual_hash(image: bytes) -> Optional[int]:
+    """
+    64-bit difference hash: each bit says whether a pixel of the 9x8
+    grayscale thumbnail is brighter than its right neighbour. Returned as a
+    signed integer so it fits a BIGINT column. None if the bytes aren't an
+    image Pillow can decode.
+    """
+    try:
+        with Image.open(io.BytesIO(image)) as im:
+            # JPEGs decode straight to a reduced size, far cheaper than full resolution
+            im.draft("L", (64, 64))
+            pixels = list(im.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    except (UnidentifiedImageError, OSError):
+        return None
+
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits - (1 << 64) if bits >= 1 << 63 else bits
+
+
+def _distance(a: int, b: int) -> int:
+    return bin((a ^ b) & ((1 << 64) - 1)).count("1")
+
+
+def _similar_in_memory(phash: int):
+    best = None
+    for cached_hash, estimate in _estimates.values():
+        if cached_hash is None:
+            continue
+        distance = _distance(phash, cached_hash)
+        if distance <= IMAGE_CACHE_MAX_DISTANCE and (best is None or distance < best[0]):
+            best = (distance, estimate)
+    return best[1] if best else None
+
+
+async def estimate_nutrition(db: AsyncSession, image: bytes, media_type: str) -> dict:
+    """
+    Nutrition facts for the image, from the in-memory LRU, then the
+    image_estimates table, then (if enabled) a near-duplicate of an earlier
+    upload, and only then from Claude. Entries are keyed by the bytes as
+    uploaded; only what goes to Claude is downscaled.
+    """
+    key = content_key(image)
+    cached = _estimates.get(key)
+    if cached is not None:
+        return cached[1]
+
+    phash = None
+    estimate = await db.run_sync(crud.get_image_estimate, key)
+    if estimate is None:
+        phash = await asyncio.to_thread(perceptual_hash, image)
+        if IMAGE_CACHE_MAX_DISTANCE and phash is not None:
+            estimate = _similar_in_memory(phash) or await db.run_sync(
+                crud.find_similar_image_estimate,
+                variant=VARIANT,
+                perceptual_hash=phash,
+                max_distance=IMAGE_CACHE_MAX_DISTANCE,
+            )
+        if estimate is None:
+            prepared = await _prepare(image, media_type)
+            estimate = json.loads(
+                await claude.estimate_nutrition(prepared.data, prepared.media_type)
+            )
+        await db.run_sync(
+            crud.create_image_estimate,
+            key=key,
+            variant=VARIANT,
+            perceptual_hash=phash,
+            result=estimate,
+        )
+
+    _estimates.put(key, (phash, estimate))
+    return estimate
+
+
+async def _prepare(image: bytes, media_type: str):
+    # decoding and resizing is CPU-bound, keep it off the event loop
+    prepared = await asyncio.to_thread(prepare_image, image, media_type)
+    logger.debug(
+        "image preprocessing: %d -> %d bytes (%d saved) in %.0f ms",
+        prepared.original_bytes,
+        len(prepared.data),
+        prepared.saved_bytes,
+        prepared.seconds * 1000,
+    )
+    return prepared
+
+
+async def _cached(db: AsyncSession, key: str):
+    cached = _estimates.get(key)
+    if cached is not None:
+        return cached[1]
+    return await db.run_sync(crud.get_image_estimate, key)
+
+
+async def submit_batch(db: AsyncSession, images) -> dict:
+    """
+    Queues estimates for the images that aren't cached yet as one Message
+    Batch, with each request's custom_id set to the image's content key.
+
+    :param images: (filename, image bytes, media type) tuples
+    :return: The batch id (None if everything was cached) and, per image, its custom_id and whether it was cached
+    """
+    pending = {}
+    listed = []
+    for filename, image, media_type in images:
+        key = content_key(image)
+        cached = key not in pending and await _cached(db, key) is not None
+        if not cached:
+            pending.setdefault(key, (image, media_type))
+        listed.append({"filename": filename, "custom_id": key, "cached": cached})
+
+    if not pending:
+        return {"batch_id": None, "images": listed}
+
+    prepared = await asyncio.gather(
+        *(_prepare(image, media_type) for image, media_type in pending.values())
+    )
+    batch = await claude.create_nutrition_batch(
+        [(key, p.data, p.media_type) for key, p in zip(pending, prepared)]
+    )
+    return {"batch_id": batch["id"], "images": listed}
+
+
+async def collect_batch(db: AsyncSession, batch_id: str) -> dict:
+    """
+    Status of a batch from submit_batch. Once it has ended, the successful
+    estimates are stored like any other, so uploading those images again is
+    answered from the cache, and returned by custom_id along with errors.
+    """
+    batch = await claude.get_batch(batch_id)
+    if batch["processing_status"] != "ended":
+        return {"status": batch["processing_status"], "counts": batch["request_counts"]}
+
+    results = {}
+    for key, result in (await claude.batch_results(batch)).items():
+        if result["type"] != "succeeded":
+            results[key] = {"error": result.get("error") or result["type"]}
+            continue
+        try:
+            estimate = json.loads(
+                "".join(block.get("text", "") for block in result["message"]["content"])
+            )
+        except json.JSONDecodeError as e:
+            results[key] = {"error": str(e)}
+            continue
+        await db.run_sync(
+            crud.create_image_estimate,
+            key=key,
+            variant=VARIANT,
+            perceptual_hash=None,
+            result=estimate,
+        )
+        _estimates.put(key, (None, estimate))
+        results[key] = {"result": estimate}
+    return {"status": "ended", "results": results}
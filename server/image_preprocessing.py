@@ -0,0 +1,69 @@
+import io
+import os
+import time
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# longest edge sent to the model. Claude downsizes anything past ~1568px
+# itself, so larger images only cost upload time and latency
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1568"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+
+
+class PreparedImage(NamedTuple):
+    data: bytes
+    media_type: str
+    original_bytes: int
+    seconds: float
+
+    @property
+    def saved_bytes(self):
+        return self.original_bytes - len(self.data)
+
+
+def prepare_image(
+    image: bytes,
+    media_type: str,
+    max_dimension: int = IMAGE_MAX_DIMENSION,
+    quality: int = IMAGE_JPEG_QUALITY,
+) -> PreparedImage:
+    """
+    Decodes the upload, applies its EXIF orientation, shrinks it to fit
+    max_dimension and re-encodes it as a JPEG without any metadata. Bytes
+    Pillow can't decode are passed through unchanged.
+    """
+    start = time.perf_counter()
+    try:
+        with Image.open(io.BytesIO(image)) as im:
+            # JPEGs can decode at 1/2, 1/4 or 1/8 scale directly, as long
+            # as the result still covers the target size
+            scale = min(1.0, max_dimension / max(im.size))
+            im.draft("RGB", (round(im.width * scale), round(im.height * scale)))
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+            out = io.BytesIO()
+            im.convert("RGB").save(out, "JPEG", quality=quality)
+    except (UnidentifiedImageError, OSError):
+        return PreparedImage(image, media_type, len(image), time.perf_counter() - start)
+
+    return PreparedImage(out.getvalue(), "image/jpeg", len(image), time.perf_counter() - start)
+
+
+# EXIF tags: the Exif sub-IFD, and DateTimeOriginal inside it
+_EXIF_IFD = 0x8769
+_DATE_TIME_ORIGINAL = 0x9003
+
+
+def taken_at(image: bytes) -> Optional[datetime]:
+    """
+    When the photo was taken, from its EXIF DateTimeOriginal, in the camera's
+    local time. None if the image has no such tag or can't be decoded.
+    """
+    try:
+        with Image.open(io.BytesIO(image)) as im:
+            value = im.getexif().get_ifd(_EXIF_IFD).get(_DATE_TIME_ORIGINAL)
+        return datetime.strptime(value.strip("\x00 "), "%Y:%m:%d %H:%M:%S") if value else None
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
@@ -0,0 +1,119 @@
+import csv
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import numpy as np
+
+from requests2 import GlucoseCreate
+
+# int64 epoch seconds + int16 mg/dL, little-endian, no padding
+BINARY_RECORD = np.dtype([("timestamp", "<i8"), ("glucose_value", "<i2")])
+
+
+class _LineParser(ABC):
+    """
+    Splits a byte stream into lines across chunk boundaries and parses each
+    complete line into a (timestamp, glucose_value) row.
+    """
+
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data: bytes):
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        return [row for row in map(self.parse_line, lines) if row is not None]
+
+    def close(self):
+        line, self.buffer = self.buffer, b""
+        row = self.parse_line(line)
+        return [row] if row is not None else []
+
+    @abstractmethod
+    def parse_line(self, line: bytes):
+        """
+        :return: A (timestamp, glucose_value) row, or None for lines without one
+        """
+
+
+class NDJSONParser(_LineParser):
+    """
+    One GlucoseCreate JSON object per line, same fields as /glucose/upload/.
+    """
+
+    def parse_line(self, line):
+        if not line.strip():
+            return None
+        record = GlucoseCreate.model_validate_json(line)
+        return record.timestamp, record.glucose_value
+
+
+class CSVParser(_LineParser):
+    """
+    timestamp,value rows with a header line, the format scripts/csv_to_json.py
+    reads. The value column may also be called glucose_value.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.columns = None
+
+    def parse_line(self, line):
+        line = line.decode("utf-8").strip()
+        if not line:
+            return None
+        fields = next(csv.reader([line]))
+        if self.columns is None:
+            self.columns = fields
+            if "timestamp" not in fields or not {"value", "glucose_value"} & set(fields):
+                raise ValueError("CSV header needs timestamp and value columns")
+            return None
+        row = dict(zip(self.columns, fields))
+        return (
+            datetime.strptime(row["timestamp"], "%Y-%m-%d %H:%M:%S"),
+            int(row.get("value") or row["glucose_value"]),
+        )
+
+
+class BinaryParser:
+    """
+    Packed BINARY_RECORD structs, decoded a whole chunk at a time.
+    """
+
+    def __init__(self):
+        self.buffer = b""
+
+    def feed(self, data: bytes):
+        self.buffer += data
+        usable = len(self.buffer) - len(self.buffer) % BINARY_RECORD.itemsize
+        records = np.frombuffer(self.buffer[:usable], dtype=BINARY_RECORD)
+        self.buffer = self.buffer[usable:]
+        return list(
+            zip(
+                records["timestamp"].astype("datetime64[s]").tolist(),
+                records["glucose_value"].tolist(),
+            )
+        )
+
+    def close(self):
+        if self.buffer:
+            raise ValueError(
+                f"Trailing {len(self.buffer)} bytes are not a whole {BINARY_RECORD.itemsize}-byte record"
+            )
+        return []
+
+
+PARSERS = {
+    "application/x-ndjson": NDJSONParser,
+    "application/jsonl": NDJSONParser,
+    "text/csv": CSVParser,
+    "application/octet-stream": BinaryParser,
+}
+
+
+def parser_for(content_type: str):
+    """
+    :return: A fresh parser for the request's content type, or None if unsupported
+    """
+    parser = PARSERS.get(content_type.split(";")[0].strip().lower())
+    return parser() if parser else None
@@ -1,39 +1,74 @@
-import json
 import random
-import re
+from typing import NamedTuple
 
-# Load the data (assume it's in a file named 'grocery_data.json')
-with open("data/instacart_stores.json", "r") as f:
-    data = json.load(f)
+from catalog_index import TokenIndex
+from catalog_store import CatalogStore
 
 
-def search_stores(query, location):
+class StoreSearch:
     """
-    Search for stores based on name, tags, or location.
-
-    :param query: String to search for in store name or tags
-    :param location: String to search for in store location
-    :return: List of matching stores
+    search_stores over a list of stores, with name/tag and city/state token
+    indexes built once up front.
     """
-    results = []
-    query = query.lower()
-    location = location.lower()
-
-    for store in data:
-        store_name = store["name"].lower()
-        store_tags = [tag.lower() for tag in store["tags"]]
-        store_location = (
-            f"{store['location']['city']}, {store['location']['state']}".lower()
+
+    def __init__(self, stores):
+        self.stores = stores
+        self.by_name = TokenIndex(
+            (i, [store["name"], *store["tags"]]) for i, store in enumerate(stores)
+        )
+        self.by_location = TokenIndex(
+            (i, [store["location"]["city"], store["location"]["state"]])
+            for i, store in enumerate(stores)
         )
 
-        if (
-            re.search(query, store_name)
-            or any(re.search(query, tag) for tag in store_tags)
-            or re.search(location, store_location)
-        ):
-            results.append(store)
+    def search(self, query, location):
+        matches = self.by_name.search(query) | self.by_location.search(location)
+        return [self.stores[i] for i in sorted(matches)]
+
+
+class Catalog(NamedTuple):
+    stores: list
+    # id -> store, and (store id, item id) -> item
+    stores_by_id: dict
+    items_by_id: dict
+    search: StoreSearch
+
+
+def _build(stores) -> Catalog:
+    return Catalog(
+        stores=stores,
+        stores_by_id={store["id"]: store for store in stores},
+        items_by_id={
+            (store["id"], item["id"]): item for store in stores for item in store["products"]
+        },
+        search=StoreSearch(stores),
+    )
+
+
+_catalog = CatalogStore("instacart_stores.json", _build)
 
-    return results
+
+def catalog() -> Catalog:
+    """
+    The current catalog and its indexes, reloaded when the file changes.
+    Hold on to one result for operations that need a consistent view.
+    """
+    return _catalog.get()
+
+
+def search_stores(query, location):
+    """
+    Search for stores based on name, tags, or location.
+
+    Words match whole words, their beginnings ("org" finds "organic") or,
+    failing that, words one typo away. An empty query or location matches
+    every store.
+
+    :param query: Words to search for in store name or tags
+    :param location: Words to search for in store city and state
+    :return: List of matching stores, in catalog order
+    """
+    return catalog().search.search(query, location)
 
 
 def get_menu(store_id):
@@ -43,32 +78,29 @@ def get_menu(store_id):
     :param store_id: ID of the store
     :return: List of products for the store, or None if store not found
     """
-    for store in data:
-        if store["id"] == store_id:
-            return store["products"]
-    return None
+    store = catalog().stores_by_id.get(store_id)
+    return store["products"] if store else None
 
 
-def create_order(store_id, items):
+def price_items(store_id, items, current=None):
     """
-    Create an order for a specific store.
+    Prices a cart with one lookup per item, so the cost depends only on the
+    size of the cart. Items the store doesn't have are skipped.
 
     :param store_id: ID of the store
     :param items: List of dictionaries, each containing 'id' and 'quantity'
-    :return: Dictionary with order details, or None if store not found
+    :param current: Catalog to price from, the current one by default
+    :return: The priced order lines and their total
     """
-    store = next((s for s in data if s["id"] == store_id), None)
-    if not store:
-        return None
-
-    order = {"store_name": store["name"], "items": [], "total": 0}
-
+    items_by_id = (current or catalog()).items_by_id
+    lines = []
+    total = 0
     for item in items:
-        product = next((p for p in store["products"] if p["id"] == item["id"]), None)
+        product = items_by_id.get((store_id, item["id"]))
         if product:
             quantity = item["quantity"]
             item_total = product["price"] * quantity
-            order["items"].append(
+            lines.append(
                 {
                     "name": product["name"],
                     "quantity": quantity,
@@ -76,9 +108,25 @@ def create_order(store_id, items):
                     "total": item_total,
                 }
             )
-            order["total"] += item_total
+            total += item_total
+    return lines, total
+
+
+def create_order(store_id, items):
+    """
+    Create an order for a specific store.
+
+    :param store_id: ID of the store
+    :param items: List of dictionaries, each containing 'id' and 'quantity'
+    :return: Dictionary with order details, or None if store not found
+    """
+    current = catalog()
+    store = current.stores_by_id.get(store_id)
+    if not store:
+        return None
 
-    return order
+    lines, total = price_items(store_id, items, current)
+    return {"store_name": store["name"], "items": lines, "total": total}
 
 
 # Example usage:
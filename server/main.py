@@ -1,22 +1,26 @@
+import asyncio
 import datetime
-from itertools import chain
-import json
-from typing import List, Optional
-import anthropic
-from fastapi import FastAPI, Depends, HTTPException, Query, UploadFile, File
+from typing import List, Literal, Optional
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from db import engine, Base, get_db
-from models import GlucoseReading, Test, TimeSeriesEvent
-from crud import combined_data_query, create_glucose_batch
+from db import engine, Base, AsyncSessionLocal, get_async_db, get_db, SessionLocal
+from models import GlucoseExcursion, GlucoseReading, Test, TimeSeriesEvent
 import requests2
 import crud
-import base64
-from fastapi.responses import JSONResponse
+import image_cache
+import ingest
+import recommendation_cache
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 import os
-from datetime import datetime
-from detection import interesting_events, time_ranges_of_interest
-from prompts import NUTRITION_FACTS_PLEASE_PROMPT
+import sys
+import uuid
+from datetime import datetime, timedelta
+from detection import interesting_events
+from image_preprocessing import taken_at
+from streaming import RecommendationParser, sse
 
 app = FastAPI()
 
@@ -33,97 +37,121 @@ app.add_middleware(
 # Create the database tables
 Base.metadata.create_all(bind=engine)
 
+# Materialize excursions for readings ingested before glucose_excursions existed
+with SessionLocal() as db:
+    if db.query(GlucoseExcursion).first() is None and db.query(GlucoseReading).first():
+        crud.refresh_glucose_excursions(db)
+        db.commit()
+
 IMAGE_UPLOAD_DIRECTORY = "uploads"
 os.makedirs(IMAGE_UPLOAD_DIRECTORY, exist_ok=True)
 
 ################################################################################
 # read endpoints
 ################################################################################
+
+# Queries run on the event loop, but turning a long window's rows into a
+# response is CPU-bound, so it happens in a worker thread (see the fetch_*
+# functions in crud) along with the JSON encoding, rather than stalling
+# every other request.
+def encode_response(content) -> JSONResponse:
+    return JSONResponse(content=jsonable_encoder(content))
+
+
 @app.get("/interesting-events/")
-def read_interesting_events(
+async def read_interesting_events(
     hyperglycemic_threshold: int = 180,
     hypoglycemic_threshold: int = 70,
     quickly_raising_threshold: float = 2.0,
     quickly_dropping_threshold: float = 2.0,
     lookback_minutes: int = 60,
-    db: Session = Depends(get_db)
+    start: Optional[datetime] = Query(None, format="%Y-%m-%d %H:%M:%S"),
+    end: Optional[datetime] = Query(None, format="%Y-%m-%d %H:%M:%S"),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    glucose_readings = db.query(GlucoseReading).all()
-    events = db.query(TimeSeriesEvent).all()
-    times = time_ranges_of_interest(
-        glucose_readings,
+    times = await crud.fetch_time_ranges_of_interest(
+        db,
+        start=start,
+        end=end,
         hyperglycemic_threshold=hyperglycemic_threshold,
         hypoglycemic_threshold=hypoglycemic_threshold,
         quickly_dropping_threshold=quickly_dropping_threshold,
         quickly_raising_threshold=quickly_raising_threshold,
     )
-    return interesting_events(times, events, lookback_minutes=lookback_minutes)
+    # events up to lookback_minutes before any range can still explain it
+    bounds = [bound for ranges in times.values() for span in ranges for bound in span]
+    if start:
+        start = min([start, *bounds])
+    if end:
+        end = max([end, *bounds])
+    events = await crud.fetch_time_series_events_in_range(
+        db,
+        start=start - timedelta(minutes=lookback_minutes) if start else None,
+        end=end,
+    )
+    return await asyncio.to_thread(
+        lambda: encode_response(interesting_events(times, events, lookback_minutes=lookback_minutes))
+    )
 
 
 @app.get("/interesting-times/")
-def read_interesting_times(
+async def read_interesting_times(
     hyperglycemic_threshold: int = 180,
     hypoglycemic_threshold: int = 70,
     rate_of_change_threshold: float = 2.0,
-    db: Session = Depends(get_db)):
-    glucose_readings = db.query(GlucoseReading).all()
-    return time_ranges_of_interest(
-        glucose_readings,
+    start: Optional[datetime] = Query(None, format="%Y-%m-%d %H:%M:%S"),
+    end: Optional[datetime] = Query(None, format="%Y-%m-%d %H:%M:%S"),
+    db: AsyncSession = Depends(get_async_db)):
+    times = await crud.fetch_time_ranges_of_interest(
+        db,
+        start=start,
+        end=end,
         hyperglycemic_threshold=hyperglycemic_threshold,
         hypoglycemic_threshold=hypoglycemic_threshold,
         quickly_dropping_threshold=rate_of_change_threshold,
         quickly_raising_threshold=rate_of_change_threshold
     )
+    return await asyncio.to_thread(encode_response, times)
 
 @app.get("/combined-data/")
-def get_all_data(
+async def get_all_data(
     start: datetime = Query(None, format="%Y-%m-%d %H:%M:%S"),
     end: datetime = Query(None, format="%Y-%m-%d %H:%M:%S"),
     type: List[str] = Query([]),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        return combined_data_query(
-            db=db,
-            start=start,
-            end=end,
-            type=type
-        )
+        input_data = crud.CombinedDataInput(start=start, end=end, type=type)
+        combined_data = await crud.fetch_combined_data(db, input_data)
+        return await asyncio.to_thread(encode_response, combined_data)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/glucose/", response_model=List[requests2.GlucoseCreate])
-def get_glucose_data(
+async def get_glucose_data(
     start: Optional[datetime] = Query(None, format="%Y-%m-%d %H:%M:%S"),
     end: Optional[datetime] = Query(None, format="%Y-%m-%d %H:%M:%S"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    query = db.query(GlucoseReading)
-
-    if start:
-        query = query.filter(GlucoseReading.timestamp >= start)
-    if end:
-        query = query.filter(GlucoseReading.timestamp <= end)
-
-    glucose_data = query.all()
+    glucose_data = await crud.fetch_glucose_records(db, start=start, end=end)
 
     if not glucose_data:
         raise HTTPException(status_code=404, detail="No data found")
 
-    return glucose_data
+    return await asyncio.to_thread(JSONResponse, content=glucose_data)
 
 @app.get("/events/", response_model=List[requests2.TimeSeriesEventRead])
-def read_events(
+async def read_events(
     skip: int = 0,
     limit: int = 100,
     start: Optional[datetime] = Query(None, format="%Y-%m-%d %H:%M:%S"),
     end: Optional[datetime] = Query(None, format="%Y-%m-%d %H:%M:%S"),
     type: Optional[str] = None,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        return crud.get_time_series_events(
-            db=db,
+        return await db.run_sync(
+            crud.get_time_series_events,
             skip=skip,
             limit=limit,
             start=start,
@@ -139,77 +167,182 @@ def read_events(
 ################################################################################
 
 @app.post("/events/", response_model=requests2.TimeSeriesEventRead)
-def create_event(event: requests2.TimeSeriesEventCreate, db: Session = Depends(get_db)):
-    return crud.create_time_series_event(db=db, event=event)
+async def create_event(
+    event: requests2.TimeSeriesEventCreate, db: AsyncSession = Depends(get_async_db)
+):
+    return await db.run_sync(crud.create_time_series_event, event=event)
 
 @app.post("/glucose/upload/")
-def upload_glucose_data(
-    batch: requests2.GlucoseBatchCreate, db: Session = Depends(get_db)
+async def upload_glucose_data(
+    batch: requests2.GlucoseBatchCreate,
+    on_conflict: Literal["nothing", "update"] = "nothing",
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        return create_glucose_batch(db=db, glucose_records=batch.records)
+        return await db.run_sync(
+            crud.upsert_glucose_rows,
+            rows=((record.timestamp, record.glucose_value) for record in batch.records),
+            on_conflict=on_conflict,
+        )
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.post("/events/batch/")
-def batch_create_events(
-    events: List[requests2.TimeSeriesEventCreate], db: Session = Depends(get_db)
+# rows written per transaction by /glucose/upload/stream/
+STREAM_UPLOAD_CHUNK_ROWS = 10000
+
+@app.post("/glucose/upload/stream/")
+async def stream_glucose_data(
+    request: Request,
+    on_conflict: Literal["nothing", "update"] = "nothing",
+    db: AsyncSession = Depends(get_async_db)
 ):
+    """
+    Streams glucose readings from the request body as NDJSON
+    (application/x-ndjson), CSV (text/csv) or packed int64 epoch + int16
+    value records (application/octet-stream), committing every
+    STREAM_UPLOAD_CHUNK_ROWS rows. Chunks committed before an error stay
+    committed, re-sending the upload is safe since it upserts.
+    """
+    parser = ingest.parser_for(request.headers.get("content-type", ""))
+    if parser is None:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported content type, expected one of {sorted(ingest.PARSERS)}",
+        )
+
+    totals = {"received": 0, "inserted": 0, "updated": 0, "skipped": 0}
+
+    async def write(rows):
+        counts = await db.run_sync(
+            crud.upsert_glucose_rows, rows=rows, on_conflict=on_conflict
+        )
+        for key, value in counts.items():
+            totals[key] += value
+
+    pending = []
     try:
-        return [
-            crud.create_time_series_event(db=db, event=event) for event in events
-        ]
+        async for data in request.stream():
+            pending.extend(parser.feed(data))
+            while len(pending) >= STREAM_UPLOAD_CHUNK_ROWS:
+                await write(pending[:STREAM_UPLOAD_CHUNK_ROWS])
+                del pending[:STREAM_UPLOAD_CHUNK_ROWS]
+        pending.extend(parser.close())
+        if pending:
+            await write(pending)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-claude_model = "claude-3-5-sonnet-20240620"  # Model name for Claude API
-client = anthropic.Anthropic()  # Initialize Claude client
+    return totals
+
+@app.post("/events/batch/")
+async def batch_create_events(
+    events: List[requests2.TimeSeriesEventCreate], db: AsyncSession = Depends(get_async_db)
+):
+    try:
+        return await db.run_sync(crud.create_time_series_events, events=events)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/upload-image/")
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(
+    file: UploadFile = File(...), db: AsyncSession = Depends(get_async_db)
+):
     try:
         # Read the file content
         file_content = await file.read()
 
-        # Convert the file content to base64
-        encoded_image_data = base64.b64encode(file_content).decode("utf-8")
-        image_media_type = file.content_type  # Get the file's media type
-
-        # Construct the payload for Claude API
-        message = client.messages.create(
-            model=claude_model,
-            max_tokens=1024,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": image_media_type,
-                                "data": encoded_image_data,
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": NUTRITION_FACTS_PLEASE_PROMPT,
-                        }
-                    ],
-                }
-            ],
+        # Repeat uploads of the same photo are answered from the cache
+        json_response = await image_cache.estimate_nutrition(
+            db, file_content, file.content_type
         )
+        return JSONResponse(content=json_response)
 
-        raw = "".join(
-            chain.from_iterable(
-                msg.text for msg in message.content
+    except Exception as e:
+        print(e)
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+# images analysed at once per /upload-images/ request
+UPLOAD_IMAGES_CONCURRENCY = int(os.getenv("UPLOAD_IMAGES_CONCURRENCY", "4"))
+
+@app.post("/upload-images/")
+async def upload_images(
+    files: List[UploadFile] = File(...),
+    persist: bool = False,
+    batch: bool = False,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Nutrition estimates for many photos at once, one result or error per
+    file in upload order. With persist, each estimate is also saved as a
+    food event at the time the photo was taken (or now, without EXIF data),
+    in one insert.
+
+    With batch, uncached images are queued through the Message Batches API
+    instead, for backfills that can wait; poll
+    /upload-images/batches/{batch_id} for the results.
+    """
+    images = [(file.filename, await file.read(), file.content_type) for file in files]
+    if batch:
+        try:
+            return await image_cache.submit_batch(db, images)
+        except Exception as e:
+            print(e)
+            return JSONResponse(content={"error": str(e)}, status_code=500)
+
+    slots = asyncio.Semaphore(UPLOAD_IMAGES_CONCURRENCY)
+
+    async def analyse(content, content_type):
+        async with slots:
+            try:
+                # sessions can't be shared between concurrent tasks
+                async with AsyncSessionLocal() as session:
+                    estimate = await image_cache.estimate_nutrition(session, content, content_type)
+                return {"result": estimate}
+            except Exception as e:
+                print(e)
+                return {"error": str(e)}
+
+    # the same photo uploaded twice is estimated once and reported for each file
+    keys = [image_cache.content_key(content) for _, content, _ in images]
+    unique = {}
+    for key, (_, content, content_type) in zip(keys, images):
+        unique.setdefault(key, (content, content_type))
+    outcomes = dict(
+        zip(unique, await asyncio.gather(*(analyse(*image) for image in unique.values())))
+    )
+    results = [
+        {"filename": filename, **outcomes[key]} for key, (filename, _, _) in zip(keys, images)
+    ]
+
+    if persist:
+        uploaded_at = datetime.now()
+        saved = []
+        events = []
+        for result, (filename, content, _) in zip(results, images):
+            estimate = result.get("result")
+            data = estimate.get("data", estimate) if isinstance(estimate, dict) else None
+            # only nutrition facts objects become food events
+            if not isinstance(data, dict):
+                continue
+            saved.append(result)
+            events.append(
+                requests2.TimeSeriesEventCreate(
+                    type="food",
+                    timestamp=taken_at(content) or uploaded_at,
+                    description=os.path.splitext(filename or "")[0] or None,
+                    data=data,
+                )
             )
-        )
+        db_events = await db.run_sync(crud.create_time_series_events, events=events)
+        for result, db_event in zip(saved, db_events):
+            result["event_id"] = db_event.id
 
-        json_response = json.loads(raw)
-        # Return the response from Claude API
-        return JSONResponse(content=json_response)
+    return results
 
+@app.get("/upload-images/batches/{batch_id}")
+async def upload_images_batch(batch_id: str, db: AsyncSession = Depends(get_async_db)):
+    try:
+        return await image_cache.collect_batch(db, batch_id)
     except Exception as e:
         print(e)
         return JSONResponse(content={"error": str(e)}, status_code=500)
@@ -219,33 +352,92 @@ def upload_consequence(consequence: requests2.CreateEventConsequence, db: Sessio
     return crud.create_event_consequence(db=db, event=consequence.event, consequence=consequence.consequence)
 
 @app.post("/consequence/recommendation-prompt/")
-def get_reccomendation(event: requests2.TimeSeriesEventCreate, db: Session = Depends(get_db)):
-    prompt = crud.generate_consequences_prompt(db=db, event=event)
-
-    message = client.messages.create(
-        model=claude_model,
-        max_tokens=1024,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    }
-                ],
-            }
-        ]
-    )
-
-    content = "".join(
-        chain.from_iterable(
-            msg.text for msg in message.content
-        )
-    )
+async def get_reccomendation(
+    event: requests2.TimeSeriesEventCreate, db: AsyncSession = Depends(get_async_db)
+):
+    # Same event against the same consequence history is answered from the cache
+    content = await recommendation_cache.recommend(db, event)
 
     return JSONResponse(content={"result": content})
 
+@app.post("/consequence/recommendation-prompt/stream/")
+async def stream_reccomendation(
+    event: requests2.TimeSeriesEventCreate, db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Server-sent events for the recommendation: "detail" with each new piece
+    of the detail text, "source" with each complete source, then "done" with
+    the whole {detail, sources} object.
+    """
+    chunks = await recommendation_cache.stream_recommendation(db, event)
+
+    async def events():
+        parser = RecommendationParser()
+        try:
+            async for text in chunks:
+                for name, data in parser.feed(text):
+                    yield sse(name, {"text": data})
+        except Exception as e:
+            print(e)
+            yield sse("error", {"error": str(e)})
+            return
+        yield sse("done", parser.result())
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.post("/agent/")
+async def run_agent(message: requests2.AgentMessage):
+    """
+    One turn of the agent on the given thread, or a new one. Reply with the
+    returned thread_id to continue the conversation.
+    """
+    # imported on first use, so the rest of the API doesn't need the agent's dependencies
+    import agent
+
+    thread_id = message.thread_id or str(uuid.uuid4())
+    try:
+        return {"thread_id": thread_id, **await agent.run(message.message, thread_id)}
+    except Exception as e:
+        print(e)
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@app.get("/agent/{thread_id}")
+async def agent_history(thread_id: str):
+    import agent
+
+    return await agent.history(thread_id)
+
+@app.post("/agent/stream/")
+async def stream_agent(message: requests2.AgentMessage):
+    """
+    Server-sent events for one turn of the agent, see agent.stream_events.
+    The first event, "thread", carries the thread id to continue the
+    conversation with.
+    """
+    # imported on first use, so the rest of the API doesn't need the agent's dependencies
+    import agent
+
+    thread_id = message.thread_id or str(uuid.uuid4())
+
+    async def events():
+        yield sse("thread", {"thread_id": thread_id})
+        try:
+            async for name, data in agent.stream_events(message.message, thread_id):
+                yield sse(name, data)
+        except Exception as e:
+            print(e)
+            yield sse("error", {"error": str(e)})
+            return
+        yield sse("done", {})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.on_event("shutdown")
+async def close_agent():
+    # only if an agent endpoint was used and imported it
+    if "agent" in sys.modules:
+        await sys.modules["agent"].close()
+
 @app.delete("/events/{event_id}")
 def delete_event(event_id: int, db: Session = Depends(get_db)):
     return crud.delete_timeseries_event(db=db, event_id=event_id)
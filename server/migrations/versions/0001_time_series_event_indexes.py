@@ -0,0 +1,43 @@
+"""time_series_events indexes for type/timestamp filters and nutrient lookups
+
+The tables themselves are created by Base.metadata.create_all in main.py,
+which also creates these indexes on a fresh database, hence if_not_exists.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_time_series_events_type_timestamp",
+        "time_series_events",
+        ["type", "timestamp"],
+        if_not_exists=True,
+    )
+    op.create_index(
+        "ix_time_series_events_timestamp",
+        "time_series_events",
+        ["timestamp"],
+        if_not_exists=True,
+    )
+    op.create_index(
+        "ix_time_series_events_data",
+        "time_series_events",
+        ["data"],
+        postgresql_using="gin",
+        if_not_exists=True,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_time_series_events_data", table_name="time_series_events")
+    op.drop_index("ix_time_series_events_timestamp", table_name="time_series_events")
+    op.drop_index("ix_time_series_events_type_timestamp", table_name="time_series_events")
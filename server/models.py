@@ -1,5 +1,5 @@
 import json
-from sqlalchemy import Column, Integer, String, Text, Numeric, TIMESTAMP
+from sqlalchemy import BigInteger, Column, Float, Index, Integer, String, Text, Numeric, TIMESTAMP
 from sqlalchemy.dialects.postgresql import JSONB
 from db import Base
 
@@ -26,8 +26,37 @@ class GlucoseReading(Base):
         )
 
 
+class GlucoseExcursion(Base):
+    __tablename__ = "glucose_excursions"
+    __table_args__ = (Index("ix_glucose_excursions_start_end", "start", "end"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    type = Column(String, nullable=False)
+    start = Column(TIMESTAMP, nullable=False)
+    # null while the excursion is still ongoing at the latest reading
+    end = Column(TIMESTAMP, nullable=True)
+    threshold = Column(Float, nullable=False)
+
+    def __repr__(self):
+        return json.dumps(
+            {
+                "id": self.id,
+                "type": self.type,
+                "start": self.start.isoformat(),
+                "end": self.end.isoformat() if self.end else None,
+                "threshold": self.threshold,
+            }
+        )
+
+
 class TimeSeriesEvent(Base):
     __tablename__ = "time_series_events"
+    __table_args__ = (
+        Index("ix_time_series_events_type_timestamp", "type", "timestamp"),
+        Index("ix_time_series_events_timestamp", "timestamp"),
+        # nutrient lookups, e.g. data @> '{"carbohydrate": 24}' or data ? 'insulin'
+        Index("ix_time_series_events_data", "data", postgresql_using="gin"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     type = Column(String, nullable=False)
@@ -46,6 +75,44 @@ class TimeSeriesEvent(Base):
             }
         )
 
+class ImageEstimate(Base):
+    __tablename__ = "image_estimates"
+
+    # sha256 of model, prompt and image bytes
+    key = Column(String(64), primary_key=True)
+    # sha256 of model and prompt, near-duplicate matches must share it
+    variant = Column(String(64), nullable=False, index=True)
+    # 64-bit dHash of the image, null if it couldn't be decoded
+    perceptual_hash = Column(BigInteger, nullable=True)
+    result = Column(JSONB, nullable=False)
+
+    def __repr__(self):
+        return json.dumps(
+            {
+                "key": self.key,
+                "variant": self.variant,
+                "perceptual_hash": self.perceptual_hash,
+                "result": self.result,
+            }
+        )
+
+
+class AgentThread(Base):
+    __tablename__ = "agent_threads"
+
+    # conversation id, the agent's checkpoints are stored under it
+    thread_id = Column(String, primary_key=True)
+    last_active = Column(TIMESTAMP, nullable=False, index=True)
+
+    def __repr__(self):
+        return json.dumps(
+            {
+                "thread_id": self.thread_id,
+                "last_active": self.last_active.isoformat(),
+            }
+        )
+
+
 class EventConsequence(Base):
     __tablename__ = "event_consequences"
 
@@ -0,0 +1,173 @@
+import operator
+import re
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import instacart
+import uber_eats
+
+NUTRIENTS = ("calories", "carbohydrate", "protein", "fat")
+
+_OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "=": operator.eq,
+    "==": operator.eq,
+}
+_CONDITION = re.compile(r"^\s*([a-z_]+)\s*(<=|>=|==|<|>|=)\s*(-?\d+(?:\.\d+)?)\s*$")
+_SEPARATOR = re.compile(r",|\band\b", re.IGNORECASE)
+
+
+def parse_conditions(text: str) -> List[Tuple[str, str, float]]:
+    """
+    "carbohydrate < 20, protein > 15" -> [("carbohydrate", "<", 20.0), ("protein", ">", 15.0)]
+    """
+    conditions = []
+    for part in _SEPARATOR.split(text or ""):
+        if not part.strip():
+            continue
+        match = _CONDITION.match(part.lower())
+        if match is None or match.group(1) not in NUTRIENTS + ("price",):
+            raise ValueError(
+                f"can't read condition {part.strip()!r}, expected e.g. 'carbohydrate < 20' "
+                f"on one of {', '.join(NUTRIENTS)} or price"
+            )
+        conditions.append((match.group(1), match.group(2), float(match.group(3))))
+    return conditions
+
+
+class NutrientMatrix:
+    """
+    Every product and menu item of the catalogs as a row of a float matrix,
+    one column per nutrient (NaN where the catalog has no nutrition facts)
+    plus price, so queries are answered with vectorized filters and top-k
+    rather than by walking the catalogs.
+    """
+
+    def __init__(self, catalogs):
+        """
+        :param catalogs: (source name, entities, key of their item list) tuples
+        """
+        self.items = []
+        rows = []
+        for source, entities, items_key in catalogs:
+            for entity in entities:
+                for item in entity[items_key]:
+                    nutrition = item.get("nutrition") or {}
+                    self.items.append((source, entity, item))
+                    rows.append(
+                        [nutrition.get(name, np.nan) for name in NUTRIENTS] + [item["price"]]
+                    )
+        self.columns = {name: i for i, name in enumerate(NUTRIENTS + ("price",))}
+        self.matrix = np.array(rows, dtype=float).reshape(len(rows), len(self.columns))
+
+    def _column(self, name: str) -> np.ndarray:
+        if name.endswith("_per_dollar") and name[: -len("_per_dollar")] in NUTRIENTS:
+            prices = self.matrix[:, self.columns["price"]]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return self.matrix[:, self.columns[name[: -len("_per_dollar")]]] / prices
+        if name not in self.columns:
+            raise ValueError(
+                f"can't sort by {name!r}, expected one of {', '.join(self.columns)} "
+                "or a nutrient followed by _per_dollar"
+            )
+        return self.matrix[:, self.columns[name]]
+
+    def search(
+        self,
+        conditions: List[Tuple[str, str, float]],
+        sort_by: Optional[str] = None,
+        descending: bool = False,
+        limit: int = 10,
+        sources: Optional[List[str]] = None,
+    ) -> List[dict]:
+        """
+        Items meeting every condition, best `limit` of them by sort_by.
+        Items without a value for a condition's or the sort's column never
+        match.
+        """
+        mask = np.ones(len(self.items), dtype=bool)
+        for name, op, value in conditions:
+            with np.errstate(invalid="ignore"):
+                mask &= _OPERATORS[op](self.matrix[:, self.columns[name]], value)
+        if sources:
+            mask &= np.fromiter(
+                (source in sources for source, _, _ in self.items), dtype=bool, count=len(self.items)
+            )
+
+        if sort_by:
+            key = self._column(sort_by)
+            mask &= np.isfinite(key)
+            candidates = np.flatnonzero(mask)
+            order = -key[candidates] if descending else key[candidates]
+            if len(candidates) > limit:
+                best = np.argpartition(order, limit - 1)[:limit]
+                candidates, order = candidates[best], order[best]
+            candidates = candidates[np.argsort(order, kind="stable")]
+        else:
+            candidates = np.flatnonzero(mask)[:limit]
+
+        return [self._describe(row, sort_by) for row in candidates]
+
+    def _describe(self, row: int, sort_by: Optional[str]) -> dict:
+        source, entity, item = self.items[row]
+        result = {
+            "source": source,
+            "store_id": entity["id"],
+            "store": entity["name"],
+            "item_id": item["id"],
+            "name": item["name"],
+            "price": item["price"],
+            "nutrition": item.get("nutrition"),
+        }
+        if sort_by and sort_by not in result and sort_by not in NUTRIENTS:
+            result[sort_by] = round(float(self._column(sort_by)[row]), 2)
+        return result
+
+
+# the catalogs the matrix was built from, and the matrix
+_cache: Optional[Tuple[tuple, NutrientMatrix]] = None
+
+
+def _matrix() -> NutrientMatrix:
+    """
+    The matrix for the current catalogs, rebuilt when either was reloaded.
+    """
+    global _cache
+    catalogs = (instacart.catalog(), uber_eats.catalog())
+    cache = _cache
+    if cache is None or any(a is not b for a, b in zip(cache[0], catalogs)):
+        matrix = NutrientMatrix(
+            [
+                ("instacart", catalogs[0].stores, "products"),
+                ("uber_eats", catalogs[1].restaurants, "menu"),
+            ]
+        )
+        cache = _cache = (catalogs, matrix)
+    return cache[1]
+
+
+def search_products(
+    conditions: str = "",
+    sort_by: Optional[str] = None,
+    descending: bool = False,
+    limit: int = 10,
+    sources: Optional[List[str]] = None,
+) -> List[dict]:
+    """
+    Products and menu items across the Instacart and Uber Eats catalogs
+    matching nutrition and price conditions.
+
+    :param conditions: Comma separated conditions, e.g. "carbohydrate < 20, protein > 15"
+    :param sort_by: A nutrient, price, or e.g. "protein_per_dollar"
+    :param descending: Largest values first
+    :param limit: Maximum number of items returned
+    :param sources: Only search these catalogs, "instacart" and/or "uber_eats"
+    :return: Matching items with their store, price and nutrition facts
+    """
+    return _matrix().search(
+        parse_conditions(conditions), sort_by=sort_by, descending=descending, limit=limit, sources=sources
+    )
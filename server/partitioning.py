@@ -0,0 +1,107 @@
+"""
+Optional monthly range partitioning for glucose_readings and time_series_events.
+
+    python partitioning.py [months_ahead]
+
+Converts each table into a table partitioned by month on its timestamp
+column, copying the existing rows over. Tables that are already partitioned
+just get any missing partitions up to `months_ahead` months from now (3 by
+default), so the same command can run from cron to keep ahead of incoming
+data. Rows outside every monthly partition land in a DEFAULT partition.
+"""
+
+import sys
+from datetime import date, datetime
+
+from sqlalchemy import text
+
+import models
+from db import engine
+
+# partition key has to be part of the primary key
+PARTITIONED_TABLES = {
+    "glucose_readings": ["timestamp"],
+    "time_series_events": ["id", "timestamp"],
+}
+
+
+def _add_months(month: date, n: int) -> date:
+    months = month.year * 12 + month.month - 1 + n
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def _is_partitioned(conn, table):
+    return (
+        conn.execute(
+            text("SELECT relkind FROM pg_class WHERE relname = :table"),
+            {"table": table},
+        ).scalar()
+        == "p"
+    )
+
+
+def ensure_monthly_partitions(conn, table, first: date, last: date):
+    """
+    Creates the monthly partitions of `table` covering first..last, plus the
+    DEFAULT partition.
+    """
+    month = date(first.year, first.month, 1)
+    while month <= last:
+        following = _add_months(month, 1)
+        conn.execute(
+            text(
+                f'CREATE TABLE IF NOT EXISTS "{table}_y{month.year}m{month.month:02d}" '
+                f'PARTITION OF "{table}" '
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')"
+            )
+        )
+        month = following
+    conn.execute(
+        text(f'CREATE TABLE IF NOT EXISTS "{table}_default" PARTITION OF "{table}" DEFAULT')
+    )
+
+
+def partition_table(conn, table, months_ahead=3):
+    horizon = _add_months(date.today(), months_ahead)
+
+    if _is_partitioned(conn, table):
+        ensure_monthly_partitions(conn, table, date.today(), horizon)
+        return
+
+    bounds = conn.execute(
+        text(f'SELECT min("timestamp"), max("timestamp") FROM "{table}"')
+    ).one()
+    first = bounds[0].date() if bounds[0] else date.today()
+    last = max(bounds[1].date(), horizon) if bounds[1] else horizon
+    sequence = conn.execute(
+        text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": table}
+    ).scalar() if "id" in PARTITIONED_TABLES[table] else None
+
+    old = f"{table}_unpartitioned"
+    conn.execute(text(f'ALTER TABLE "{table}" RENAME TO "{old}"'))
+    conn.execute(
+        text(
+            f'CREATE TABLE "{table}" (LIKE "{old}" INCLUDING DEFAULTS) '
+            f'PARTITION BY RANGE ("timestamp")'
+        )
+    )
+    if sequence:
+        # keep the id sequence alive when the old table is dropped
+        conn.execute(text(f'ALTER SEQUENCE {sequence} OWNED BY "{table}".id'))
+    ensure_monthly_partitions(conn, table, first, last)
+
+    conn.execute(text(f'INSERT INTO "{table}" SELECT * FROM "{old}"'))
+    conn.execute(text(f'DROP TABLE "{old}"'))
+
+    primary_key = ", ".join(f'"{column}"' for column in PARTITIONED_TABLES[table])
+    conn.execute(text(f'ALTER TABLE "{table}" ADD PRIMARY KEY ({primary_key})'))
+    for index in models.Base.metadata.tables[table].indexes:
+        index.create(conn)
+
+
+if __name__ == "__main__":
+    months_ahead = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    for table in PARTITIONED_TABLES:
+        with engine.begin() as conn:
+            partition_table(conn, table, months_ahead=months_ahead)
+        print(f"{datetime.now().isoformat()} {table} partitioned by month")
@@ -56,4 +56,38 @@ data": {
 where each value is in grams or milligrams, and the total sum of calories from fat, carbohydrates, and protein should add up to the total calorie count.
 
 ONLY OUTPUT THIS JSON OBJECT. DO NOT INCLUDE ANY OTHER INFORMATION OR TEXT IN YOUR RESPONSE.
-"""
\ No newline at end of file
+"""
+
+CONSEQUENCES_PROMPT = """
+You are a diabetes specialist and are being given data from a patient of yours.
+The data consists of a series of events and their consequences.
+
+For example, an event might be a patient eating a meal, and the consequence might be hyperglycemia.
+
+consequences are structured as follows:
+
+<JSON event data> -> <consequence>
+
+Given the list of consequences below, as well as the event in question, please select the most likely consequence,
+and make a recommendation to the patient based on that consequence. You should also provide a brief explanation of your reasoning.
+
+Your response should be structured as only JSON of the following structure:
+
+{
+    detail: string,
+    sources: string[]
+}
+detail should be no more than 3 sentences. You should start out detail similarly to the following:
+
+"Based on your historical data, ______ will most likely result in ______. I recommend that you ______."
+
+sources should be a string[] of examples of past events that support your recommendation. If you have no direct sources,
+feel free to extrapolate based on other related events, or outside knowledge.
+
+for example:
+
+{
+    detail: "Based on your historical data, eating a meal will most likely result in hyperglycemia. I recommend that you take a walk after eating.",
+    sources: ["eating Sun-dried tomatoes on 2021-01-01 resulted in hyperglycemia"]
+}
+"""
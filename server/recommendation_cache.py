@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+from typing import AsyncIterator
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import claude
+import crud
+from cache import TTLCache
+from requests2 import TimeSeriesEventCreate
+
+RECOMMENDATION_CACHE_SIZE = int(os.getenv("RECOMMENDATION_CACHE_SIZE", "1024"))
+RECOMMENDATION_CACHE_TTL_SECONDS = float(
+    os.getenv("RECOMMENDATION_CACHE_TTL_SECONDS", "3600")
+)
+
+# (fingerprint, event_consequences version) -> recommendation
+_recommendations = TTLCache(RECOMMENDATION_CACHE_SIZE, RECOMMENDATION_CACHE_TTL_SECONDS)
+
+
+def _normalize(value):
+    if isinstance(value, dict):
+        return {str(k).strip().lower(): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, str):
+        return " ".join(value.split()).lower()
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        # 30 and 30.0 grams are the same meal
+        return round(float(value), 6)
+    return str(value)
+
+
+def fingerprint(event: TimeSeriesEventCreate) -> str:
+    """
+    Hash of the event's type, description and data, ignoring case, extra
+    whitespace, key order and the timestamp, which doesn't change the advice.
+    """
+    normalized = _normalize(
+        {"type": event.type, "description": event.description, "data": event.data}
+    )
+    return hashlib.sha256(
+        json.dumps(normalized, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+async def recommend(db: AsyncSession, event: TimeSeriesEventCreate) -> str:
+    """
+    Claude's recommendation for the event, reused for the same event until
+    the TTL runs out or a consequence is added to the history it was based on.
+    """
+    version = await db.run_sync(crud.get_event_consequences_version)
+    key = (fingerprint(event), version)
+    cached = _recommendations.get(key)
+    if cached is not None:
+        return cached
+
+    prompt = await db.run_sync(
+        lambda session: crud.generate_consequences_prompt(event=event, db=session)
+    )
+    content = await claude.recommend(prompt)
+    _recommendations.put(key, content)
+    return content
+
+
+async def _replay(content: str):
+    yield content
+
+
+async def _stream_and_cache(key, prompt: str):
+    chunks = []
+    async for text in claude.stream_recommendation(prompt):
+        chunks.append(text)
+        yield text
+    _recommendations.put(key, "".join(chunks))
+
+
+async def stream_recommendation(
+    db: AsyncSession, event: TimeSeriesEventCreate
+) -> AsyncIterator[str]:
+    """
+    recommend, as an iterator over the text as it arrives. A cached answer
+    comes out as a single chunk; a fresh one is cached once it has streamed
+    in full. The database is only used before this returns, so the session
+    can be closed while the response streams.
+    """
+    version = await db.run_sync(crud.get_event_consequences_version)
+    key = (fingerprint(event), version)
+    cached = _recommendations.get(key)
+    if cached is not None:
+        return _replay(cached)
+
+    prompt = await db.run_sync(
+        lambda session: crud.generate_consequences_prompt(event=event, db=session)
+    )
+    return _stream_and_cache(key, prompt)
@@ -37,3 +37,8 @@ class TimeSeriesEventRead(BaseModel):
 class CreateEventConsequence(BaseModel):
     event: TimeSeriesEventCreate
     consequence: str
+
+
+class AgentMessage(BaseModel):
+    message: str
+    thread_id: Optional[str] = None
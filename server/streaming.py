@@ -0,0 +1,120 @@
+import json
+import re
+from typing import List, Tuple
+
+_KEY = re.compile(r'"?(detail|sources)"?\s*:\s*')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_ESCAPE = re.compile(r'\\(?:u[0-9a-fA-F]{4}|[^u])')
+
+
+def sse(event: str, data) -> str:
+    """
+    One server-sent event, with data as JSON.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class RecommendationParser:
+    """
+    Incremental parser for the {detail, sources} object the recommendation
+    prompt asks for. Feed it text as it streams in and it returns the new
+    events: ("detail", text) as the detail string grows and ("source", text)
+    each time an entry of sources is complete. Keys may be quoted or not
+    (the prompt's own example doesn't quote them) and come in either order;
+    anything else in the output is skipped.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.detail = ""
+        self.sources: List[str] = []
+        self._pos = 0
+        self._field = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        self.text += chunk
+        events = []
+        while True:
+            if self._field is None:
+                progressed = self._find_field()
+            elif self._field == "detail":
+                progressed = self._read_detail(events)
+            else:
+                progressed = self._read_source(events)
+            if not progressed:
+                return events
+
+    def result(self) -> dict:
+        """
+        The parsed object so far. If the model didn't answer in the expected
+        shape, detail is its whole output.
+        """
+        if not self.detail and not self.sources:
+            return {"detail": self.text.strip(), "sources": []}
+        return {"detail": self.detail, "sources": self.sources}
+
+    def _find_field(self) -> bool:
+        match = _KEY.search(self.text, self._pos)
+        if match is None or match.end() == len(self.text):
+            return False
+        opener = self.text[match.end()]
+        if match.group(1) == "detail" and opener == '"':
+            self._field = "detail"
+        elif match.group(1) == "sources" and opener == "[":
+            self._field = "sources"
+        self._pos = match.end() + 1
+        return True
+
+    def _read_detail(self, events) -> bool:
+        text, pos = self.text, self._pos
+        decoded = []
+        while pos < len(text):
+            char = text[pos]
+            if char == '"':
+                self._field = None
+                pos += 1
+                break
+            if char == "\\":
+                escape = _ESCAPE.match(text, pos)
+                if escape is None:
+                    # wait for the rest of the escape sequence
+                    break
+                decoded.append(json.loads(f'"{escape.group()}"'))
+                pos = escape.end()
+            else:
+                decoded.append(char)
+                pos += 1
+
+        progressed = pos != self._pos
+        self._pos = pos
+        if decoded:
+            delta = "".join(decoded)
+            self.detail += delta
+            events.append(("detail", delta))
+        return progressed and self._field is None
+
+    def _read_source(self, events) -> bool:
+        text, pos = self.text, self._pos
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+        self._pos = pos
+        if pos == len(text):
+            return False
+        if text[pos] == "]":
+            self._field = None
+            self._pos = pos + 1
+            return True
+        if text[pos] != '"':
+            self._pos = pos + 1
+            return True
+        literal = _STRING.match(text, pos)
+        if literal is None:
+            return False
+        try:
+            source = json.loads(literal.group())
+        except json.JSONDecodeError:
+            source = literal.group()[1:-1]
+        self.sources.append(source)
+        events.append(("source", source))
+        self._pos = literal.end()
+        return True
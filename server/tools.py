@@ -1,18 +1,22 @@
 from datetime import datetime
+import os
 import random
 from pydantic import BaseModel, Field
-from typing import Annotated, List
+from typing import Annotated, List, Optional
 
 from humanlayer.core.approval import HumanLayer
 from langchain_core.callbacks import (
     AsyncCallbackManagerForToolRun,
     CallbackManagerForToolRun,
 )
+from langchain_core.runnables import RunnableConfig
 from langchain_core.tools import BaseTool
 from langchain_core.tools import StructuredTool
 
 from channels import dm_with_ceo
-from crud import combined_data_query
+from cache import TTLCache
+from crud import summarize_combined_data
+from nutrient_search import search_products
 
 hl = HumanLayer()
 
@@ -29,19 +33,73 @@ class CombinedDataInput(BaseModel):
     type: List[str] = Field(
         description="List of types of data out of possible types: insulin, sleep, food, exercise, glucose"
     )
+    raw: bool = Field(
+        default=False,
+        description="Also return every individual reading and event. Only set this if the hourly and daily summaries aren't enough",
+    )
 
 
 class InputData(BaseModel):
     input_data: CombinedDataInput
 
 
+# results of identical queries within a conversation, keyed by thread id
+FETCH_DATA_CACHE_SIZE = int(os.getenv("FETCH_DATA_CACHE_SIZE", "256"))
+FETCH_DATA_CACHE_TTL_SECONDS = float(os.getenv("FETCH_DATA_CACHE_TTL_SECONDS", "600"))
+_query_results = TTLCache(FETCH_DATA_CACHE_SIZE, FETCH_DATA_CACHE_TTL_SECONDS)
+
+
+def fetch_data_from_query(input_data: CombinedDataInput, config: RunnableConfig) -> dict:
+    """
+    summarize_combined_data for the agent, memoized per conversation.
+    """
+    key = (
+        config.get("configurable", {}).get("thread_id"),
+        input_data.start,
+        input_data.end,
+        tuple(sorted(input_data.type or [])),
+        input_data.raw,
+    )
+    result = _query_results.get(key)
+    if result is None:
+        result = summarize_combined_data(input_data, raw=input_data.raw)
+        _query_results.put(key, result)
+    return result
+
+
 fetchDataFromQuery = StructuredTool.from_function(
-    func=combined_data_query,
+    func=fetch_data_from_query,
     name="FetchDataFromQuery",
-    description='Useful for when you need to fetch health data for a particular data source for a given time period. Put all date time in this format "2024-09-12 07:30:00"',
+    description='Useful for when you need to fetch health data for a particular data source for a given time period. Returns glucose aggregated per hour (mean, min, max, readings, time_in_range_pct for 70-180 mg/dL) and events summarized per day and type (count, descriptions, totals of their data). Put all date time in this format "2024-09-12 07:30:00"',
     args_schema=InputData,
     return_direct=False,
 )
+# Nutrition search over the Instacart and Uber Eats catalogs
+
+
+class ProductSearchInput(BaseModel):
+    conditions: str = Field(
+        default="",
+        description='Comma separated conditions on calories, carbohydrate, protein, fat (grams) or price, e.g. "carbohydrate < 20, protein > 15"',
+    )
+    sort_by: Optional[str] = Field(
+        default=None,
+        description='A nutrient, price, or a nutrient per dollar such as "protein_per_dollar"',
+    )
+    descending: bool = Field(default=False, description="Sort largest first")
+    limit: int = Field(default=10, description="Maximum number of items to return")
+    sources: Optional[List[str]] = Field(
+        default=None, description='Only search "instacart" and/or "uber_eats"'
+    )
+
+
+searchProductsByNutrition = StructuredTool.from_function(
+    func=search_products,
+    name="SearchProductsByNutrition",
+    description="Finds grocery products and restaurant menu items across all stores that meet nutrition and price conditions, e.g. low-carb or high-protein options, without fetching whole menus. Only Instacart products have nutrition facts",
+    args_schema=ProductSearchInput,
+    return_direct=False,
+)
 # Instacart mock calls
 
 
@@ -1,10 +1,38 @@
-import json
 import random
 import re
+from typing import NamedTuple
 
-# Load the data (assume it's in a file named 'grocery_data.json')
-with open("data/uber_eats_restaurants.json", "r") as f:
-    data = json.load(f)
+from catalog_store import CatalogStore
+
+
+class Catalog(NamedTuple):
+    restaurants: list
+    # id -> restaurant, and (restaurant id, item id) -> item
+    restaurants_by_id: dict
+    items_by_id: dict
+
+
+def _build(restaurants) -> Catalog:
+    return Catalog(
+        restaurants=restaurants,
+        restaurants_by_id={restaurant["id"]: restaurant for restaurant in restaurants},
+        items_by_id={
+            (restaurant["id"], item["id"]): item
+            for restaurant in restaurants
+            for item in restaurant["menu"]
+        },
+    )
+
+
+_catalog = CatalogStore("uber_eats_restaurants.json", _build)
+
+
+def catalog() -> Catalog:
+    """
+    The current catalog and its indexes, reloaded when the file changes.
+    Hold on to one result for operations that need a consistent view.
+    """
+    return _catalog.get()
 
 
 def search_restaurants(query, location):
@@ -19,7 +47,7 @@ def search_restaurants(query, location):
     query = query.lower()
     location = location.lower()
 
-    for restaurant in data:
+    for restaurant in catalog().restaurants:
         restaurant_name = restaurant["name"].lower()
         restaurant_tags = [tag.lower() for tag in restaurant["tags"]]
         restaurant_location = f"{restaurant['location']['city']}, {restaurant['location']['state']}".lower()
@@ -39,32 +67,29 @@ def get_menu(restaurant_id):
     :param restaurant_id: ID of the restaurant
     :return: List of menu for the restaurant, or None if restaurant not found
     """
-    for restaurant in data:
-        if restaurant["id"] == restaurant_id:
-            return restaurant["menu"]
-    return None
+    restaurant = catalog().restaurants_by_id.get(restaurant_id)
+    return restaurant["menu"] if restaurant else None
 
 
-def create_order(restaurant_id, items):
+def price_items(restaurant_id, items, current=None):
     """
-    Create an order for a specific restaurant.
+    Prices a cart with one lookup per item, so the cost depends only on the
+    size of the cart. Items the restaurant doesn't have are skipped.
 
     :param restaurant_id: ID of the restaurant
     :param items: List of dictionaries, each containing 'id' and 'quantity'
-    :return: Dictionary with order details, or None if restaurant not found
+    :param current: Catalog to price from, the current one by default
+    :return: The priced order lines and their total
     """
-    restaurant = next((s for s in data if s["id"] == restaurant_id), None)
-    if not restaurant:
-        return None
-
-    order = {"restaurant_name": restaurant["name"], "items": [], "total": 0}
-
+    items_by_id = (current or catalog()).items_by_id
+    lines = []
+    total = 0
     for item in items:
-        menu_item = next((p for p in restaurant["menu"] if p["id"] == item["id"]), None)
+        menu_item = items_by_id.get((restaurant_id, item["id"]))
         if menu_item:
             quantity = item["quantity"]
             item_total = menu_item["price"] * quantity
-            order["items"].append(
+            lines.append(
                 {
                     "name": menu_item["name"],
                     "quantity": quantity,
@@ -72,9 +97,25 @@ def create_order(restaurant_id, items):
                     "total": item_total,
                 }
             )
-            order["total"] += item_total
+            total += item_total
+    return lines, total
+
+
+def create_order(restaurant_id, items):
+    """
+    Create an order for a specific restaurant.
+
+    :param restaurant_id: ID of the restaurant
+    :param items: List of dictionaries, each containing 'id' and 'quantity'
+    :return: Dictionary with order details, or None if restaurant not found
+    """
+    current = catalog()
+    restaurant = current.restaurants_by_id.get(restaurant_id)
+    if not restaurant:
+        return None
 
-    return order
+    lines, total = price_items(restaurant_id, items, current)
+    return {"restaurant_name": restaurant["name"], "items": lines, "total": total}
 
 
 # Example usage: